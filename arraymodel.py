@@ -0,0 +1,265 @@
+import os
+from collections import deque
+from itertools import compress
+
+try:
+    import numpy as np
+except ImportError:
+    print("Need numpy")
+    print("pip install backup_excluder[numpy]")
+    raise
+
+from model import SystemTreeNode, SystemTreeBucketNode
+
+
+class SystemTreeArray(object):
+
+    def __init__(self, names, parents, sizes, nodes=None, parentPath=""):
+        """ Create an array based tree.
+
+        The nodes must be given in breadth first order: the parent of
+        the i-th node is parents[i] < i (-1 for the root), names[i] is
+        its name and sizes[i] the size of the node itself (0 for
+        directories). The path of the root is parentPath joined with
+        its name; the paths of the other nodes are built only when
+        they are needed. Subtree sizes and exclusion states are
+        computed with vectorized passes over the levels of the tree,
+        so the object model is not needed to recompute totals.
+
+        If the array mirrors a SystemTreeNode tree, nodes[i] is the
+        (node, member) pair of the i-th node, where member is the index
+        of the file in the node if it is a bucket, None otherwise.
+        """
+        super().__init__()
+        self._names = names
+        self._parentPath = parentPath
+        self._parents = np.asarray(parents, dtype=np.int64)
+        self._sizes = np.asarray(sizes, dtype=np.int64)
+        count = len(self._names)
+        depths = np.zeros(count, dtype=np.int64)
+        ancestors = self._parents
+        while np.any(ancestors >= 0):
+            hasAncestor = ancestors >= 0
+            depths += hasAncestor
+            ancestors = np.where(
+                hasAncestor, self._parents[np.maximum(ancestors, 0)], -1)
+        if count and np.any(np.diff(depths) < 0):
+            raise ValueError("nodes are not in breadth first order")
+        levels = int(depths[-1]) + 1 if count else 0
+        # self._levels[d]:self._levels[d + 1] are the nodes at depth d
+        self._levels = np.searchsorted(depths, np.arange(levels + 1))
+        self._subtreeTotalSizes = self._aggregate(self._sizes.copy())
+        self.excluded = np.zeros(count, dtype=bool)
+        self.matched = np.zeros(count, dtype=bool)
+        self.cutSizes = self._subtreeTotalSizes.copy()
+        self.states = np.full(count, SystemTreeNode.FULLY_INCLUDED,
+                              dtype=np.int8)
+        self._nodes = nodes
+        # the states and the cut sizes of the SystemTreeNode tree
+        self._syncedStates = self.states
+        self._syncedCutSizes = self.cutSizes
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def names(self):
+        return self._names
+    @property
+    def parents(self):
+        return self._parents
+    @property
+    def subtreeTotalSizes(self):
+        return self._subtreeTotalSizes
+
+    def _aggregate(self, values):
+        """ Add (in place) the values of every node to its ancestors,
+        deepest level first, and return values.
+        """
+        for depth in range(len(self._levels) - 2, 0, -1):
+            start, end = self._levels[depth], self._levels[depth + 1]
+            np.add.at(values, self._parents[start:end], values[start:end])
+        return values
+
+    def propagate(self, matchMask):
+        """ Compute the exclusion state and the cut size of every node
+        given the mask of the nodes directly matched by the filters.
+
+        Same return values of SystemTreeNode.update.
+        """
+        excluded = np.array(matchMask, dtype=bool)
+        for depth in range(1, len(self._levels) - 1):
+            start, end = self._levels[depth], self._levels[depth + 1]
+            excluded[start:end] |= excluded[self._parents[start:end]]
+        cutSizes = self._aggregate(np.where(excluded, 0, self._sizes))
+        cutNodes = self._aggregate((~excluded).astype(np.int64))
+        states = np.full(len(self), SystemTreeNode.PARTIALLY_INCLUDED,
+                         dtype=np.int8)
+        states[cutSizes == self._subtreeTotalSizes] = \
+            SystemTreeNode.FULLY_INCLUDED
+        states[excluded] = SystemTreeNode.DIRECTLY_EXCLUDED
+        self.matched = np.array(matchMask, dtype=bool)
+        self.excluded = excluded
+        self.cutSizes = cutSizes
+        self.states = states
+        if not len(self):
+            return (0, 0)
+        return (int(cutSizes[0]), int(cutNodes[0]))
+
+    def path(self, index):
+        """ Return the full path of the index-th node. """
+        names = []
+        while index >= 0:
+            names.append(self._names[index])
+            index = self._parents[index]
+        return os.path.join(self._parentPath, *reversed(names))
+
+    def update(self, cutPath):
+        """ Compute the size (in bytes and in number of tree nodes) of
+        the tree not pruned by cutPath.
+
+        Like SystemTreeNode.update, cutPath is evaluated (in Python)
+        only on the nodes not pruned by an ancestor, one level at a
+        time: only the paths of the nodes not pruned at the current
+        level are kept in memory.
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        if not len(self):
+            return self.propagate(mask)
+        # index -> path of the nodes not pruned at the current depth
+        paths = {}
+        rootPath = os.path.join(self._parentPath, self._names[0])
+        if cutPath(rootPath):
+            mask[0] = True
+        else:
+            paths[0] = rootPath
+        for depth in range(1, len(self._levels) - 1):
+            start, end = self._levels[depth], self._levels[depth + 1]
+            level = {}
+            for i in range(start, end):
+                parentPath = paths.get(int(self._parents[i]))
+                if parentPath is None:
+                    continue
+                path = os.path.join(parentPath, self._names[i])
+                if cutPath(path):
+                    mask[i] = True
+                else:
+                    level[i] = path
+            paths = level
+        return self.propagate(mask)
+
+    def _parentsExcluded(self):
+        parentsExcluded = np.zeros(len(self), dtype=bool)
+        parentsExcluded[1:] = self.excluded[self._parents[1:]]
+        return parentsExcluded
+
+    def _excludedIndexes(self):
+        return np.flatnonzero(self.matched & ~self._parentsExcluded())
+
+    def excludedPaths(self):
+        """ Return the paths reported by SystemTreeNode.update through
+        excludedPathFoundHandler: the matched nodes which are not
+        pruned by an ancestor.
+        """
+        return [self.path(i) for i in self._excludedIndexes()]
+
+    def syncSystemTree(self):
+        """ Copy the exclusion states and the cut sizes computed by the
+        last 'update' (or 'propagate') to the SystemTreeNode tree the
+        array has been built from, calling its handlers like
+        SystemTreeNode.update does.
+
+        Only the nodes whose state or cut size changed since the last
+        sync are visited.
+        """
+        if self._nodes is None:
+            raise ValueError("the tree is not built from a SystemTreeNode")
+        for i in self._excludedIndexes():
+            node, member = self._nodes[i]
+            node._excludedPathFound(self.path(i))
+        changed = ((self.states != self._syncedStates) |
+                   (self.cutSizes != self._syncedCutSizes))
+        parentsExcluded = self._parentsExcluded()
+        buckets = []
+        for i in np.flatnonzero(changed):
+            node, member = self._nodes[i]
+            if member is not None:
+                # the files of a bucket are contiguous
+                if not buckets or buckets[-1] is not node:
+                    buckets.append(node)
+                node._excluded[member] = int(self.excluded[i])
+                continue
+            state = int(self.states[i])
+            cutSize = int(self.cutSizes[i])
+            node._currentExclusionState = state
+            node._subtreeCutSize = cutSize
+            # the GUI updates the subtrees of the excluded nodes
+            if not parentsExcluded[i]:
+                node._visibilityChanged(state, cutSize)
+        for bucket in buckets:
+            excludedCount = bucket._excluded.count(1)
+            cutSize = (bucket._subtreeTotalSize -
+                       sum(compress(bucket._sizes, bucket._excluded)))
+            if excludedCount == 0:
+                state = SystemTreeNode.FULLY_INCLUDED
+            elif excludedCount == len(bucket):
+                state = SystemTreeNode.DIRECTLY_EXCLUDED
+            else:
+                state = SystemTreeNode.PARTIALLY_INCLUDED
+            bucket._currentExclusionState = state
+            bucket._subtreeCutSize = cutSize
+            if bucket.parent._currentExclusionState != \
+                    SystemTreeNode.DIRECTLY_EXCLUDED:
+                bucket._visibilityChanged(state, cutSize)
+        self._syncedStates = self.states
+        self._syncedCutSizes = self.cutSizes
+
+    @staticmethod
+    def fromSystemTree(root, parentPath=""):
+        """ Return a SystemTreeArray with the same nodes of the
+        SystemTreeNode tree root, and with its current exclusion
+        states. The files in buckets become nodes.
+
+        parentPath is the one given to 'update' on root. The array must
+        be built again if the structure of the tree changes (e.g., a
+        bucket is expanded) or if it is updated by other means.
+        """
+        names = []
+        parents = []
+        sizes = []
+        nodes = []
+        states = []
+        queue = deque([(root, -1)])
+        while queue:
+            node, parent = queue.popleft()
+            index = len(names)
+            if isinstance(node, SystemTreeBucketNode):
+                # the files of the bucket are children of its parent
+                for i, (name, size) in enumerate(zip(node.names,
+                                                     node.sizes)):
+                    names.append(name)
+                    parents.append(parent)
+                    sizes.append(size)
+                    nodes.append((node, i))
+                    states.append(SystemTreeNode.DIRECTLY_EXCLUDED
+                                  if node.isExcluded(i) else
+                                  SystemTreeNode.FULLY_INCLUDED)
+                continue
+            names.append(node.name)
+            parents.append(parent)
+            nodes.append((node, None))
+            states.append(node.exclusionState)
+            if node.children:
+                sizes.append(0)
+                for child in node.children.values():
+                    queue.append((child, index))
+            else:
+                sizes.append(node.subtreeTotalSize)
+        tree = SystemTreeArray(names, parents, sizes, nodes, parentPath)
+        tree.states = np.array(states, dtype=np.int8)
+        tree.excluded = tree.states == SystemTreeNode.DIRECTLY_EXCLUDED
+        tree.cutSizes = tree._aggregate(np.where(tree.excluded, 0,
+                                                 tree._sizes))
+        tree._syncedStates = tree.states
+        tree._syncedCutSizes = tree.cutSizes
+        return tree
@@ -0,0 +1,280 @@
+import os
+import heapq
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from model import DiskUsage
+from treestream import TreeStreamWriter, TreeBuilder, SORTED, DISK_USAGE
+
+
+__all__ = ['AsyncScanner', 'ScanError']
+
+# node is the SystemTreeNode of the directory which could not be
+# (completely) read, error the last exception raised reading it
+ScanError = namedtuple("ScanError", "path node error")
+
+""" Errors which do not go away retrying """
+_PERMANENT = (PermissionError, FileNotFoundError, NotADirectoryError)
+
+
+def _listDirectory(path):
+    """ Return the names of the subdirectories of path and the
+    os.DirEntry of its files.
+    """
+    directories = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.name)
+            elif entry.is_file(follow_symlinks=False):
+                files.append(entry)
+    return (directories, files)
+
+
+def _statFiles(entries):
+    return [(entry.name, entry.stat(follow_symlinks=False))
+            for entry in entries]
+
+
+class AsyncScanner(object):
+
+    """ Number of files whose size is read by a single call """
+    statChunk = 256
+    """ Seconds before the first retry, doubled at every retry """
+    retryDelay = 0.1
+    """ Directories read ahead of the one being written, at most """
+    maxBuffered = 1024
+
+    def __init__(self, concurrency=32, timeout=None, retries=2,
+                 bucketThreshold=None, diskUsage=False):
+        """ Scan the file system like SystemTreeNode.createSystemTree,
+        keeping up to concurrency directory listings and file stats in
+        flight at the same time.
+
+        On network file systems every listing and stat is a round trip
+        to the server: issuing many of them concurrently makes the scan
+        bound by bandwidth instead of latency. The blocking calls run
+        in a pool of concurrency threads, scheduled by asyncio.
+
+        The directories are read by concurrency workers from a queue
+        which gives precedence to the first ones in depth first order,
+        and written in that order as soon as they have been read: at
+        most maxBuffered directories are kept in memory.
+
+        A call lasting more than timeout seconds (None for no limit) or
+        failing with a transient error is retried up to retries times.
+        The directories which could not be (completely) read are not
+        renamed: their error is written in the stream, or set in the
+        scanError of their node.
+
+        A call timed out keeps its thread busy until the system call
+        returns, which on a hung mount may be never: the scan returns
+        without waiting for it, but the interpreter joins the threads
+        of the pool at exit. After a scan, pendingCalls tells how many
+        calls had not returned when it ended: a process which must not hang should
+        then flush its output and leave with os._exit (as the scan
+        command does).
+
+        If diskUsage is True the disk sizes of the nodes are computed
+        as SystemTreeNode.createSystemTree does.
+        """
+        super().__init__()
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.bucketThreshold = bucketThreshold
+        self.diskUsage = diskUsage
+        self.pendingCalls = 0
+
+    def _release(self, future):
+        self.pendingCalls -= 1
+        self._slots.release()
+        if not future.cancelled():
+            # retrieve the exception of the calls timed out
+            future.exception()
+
+    async def _call(self, function, argument):
+        """ Run function(argument) in the thread pool, retrying it on
+        timeouts and transient errors.
+        """
+        attempt = 0
+        while True:
+            await self._slots.acquire()
+            self.pendingCalls += 1
+            future = self._loop.run_in_executor(
+                self._executor, function, argument)
+            # the slot is released when the call really ends, even if
+            # it has timed out, so that no more than concurrency
+            # threads are ever blocked
+            future.add_done_callback(self._release)
+            try:
+                return await asyncio.wait_for(asyncio.shield(future),
+                                              self.timeout)
+            except asyncio.TimeoutError:
+                error = TimeoutError("timed out after {} s".format(
+                    self.timeout))
+            except _PERMANENT:
+                raise
+            except OSError as err:
+                error = err
+            if attempt >= self.retries:
+                raise error
+            await asyncio.sleep(self.retryDelay * 2 ** attempt)
+            attempt += 1
+
+    async def _readDirectory(self, path):
+        """ Return the (name, size, stat, listing) entries of the
+        directory path and the first error met reading it (None if
+        none). listing is None for the files and the future of the
+        entries of the subdirectories; stat is None without diskUsage.
+        """
+        try:
+            directories, files = await self._call(_listDirectory, path)
+        except OSError as err:
+            return ([], err)
+        # the chunks of a single directory, the calls are limited by
+        # the slots anyway
+        results = await asyncio.gather(
+            *[self._call(_statFiles, files[i:i + self.statChunk])
+              for i in range(0, len(files), self.statChunk)],
+            return_exceptions=True)
+        entries = []
+        error = None
+        for result in results:
+            if isinstance(result, OSError):
+                # like a serial scan, keep what has been read
+                if error is None:
+                    error = result
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                entries.extend(
+                    (name, stat.st_size, stat if self.diskUsage else None,
+                     None) for name, stat in result)
+        entries.extend((name, 0, None, self._loop.create_future())
+                       for name in directories)
+        if self._sort:
+            entries.sort(key=lambda entry: entry[0])
+        return (entries, error)
+
+    def _canRead(self):
+        if not self._queue:
+            return False
+        # the directory awaited by the writer is always read, or the
+        # workers could wait for a buffer that is never emptied
+        return (self._buffered < self.maxBuffered or
+                self._queue[0][0] == self._awaited)
+
+    async def _work(self):
+        """ Read the directories in the queue, adding their
+        subdirectories to it.
+        """
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(self._canRead)
+                key, path, listing = heapq.heappop(self._queue)
+                self._buffered += 1
+            try:
+                entries, error = await self._readDirectory(path)
+            except Exception as err:
+                # raised by the writer when it gets there
+                listing.set_exception(err)
+                continue
+            async with self._changed:
+                for index, (name, size, stat, child) in enumerate(entries):
+                    if child is not None:
+                        # the keys sort in depth first order
+                        heapq.heappush(self._queue, (
+                            key + (index,), os.path.join(path, name), child))
+                self._changed.notify_all()
+            listing.set_result((entries, error))
+
+    async def _write(self, handler, name, path, key, listing):
+        """ Make on handler the calls of a TreeStreamWriter for the
+        directory path, waiting for it and its subtree to be read.
+        """
+        async with self._changed:
+            self._awaited = key
+            self._changed.notify_all()
+        entries, error = await listing
+        async with self._changed:
+            self._buffered -= 1
+            self._changed.notify_all()
+        handler.startDirectory(name)
+        if error is not None:
+            handler.error(str(error))
+            self.errors.append((path, error))
+        for index, (name, size, stat, child) in enumerate(entries):
+            if child is None:
+                diskSize = None
+                if stat is not None:
+                    diskSize = self._diskUsage.diskSize(stat)
+                handler.addFile(name, size, diskSize)
+            else:
+                await self._write(handler, name, os.path.join(path, name),
+                                  key + (index,), child)
+        handler.endDirectory()
+
+    async def _scan(self, rootPath, handler):
+        self._loop = asyncio.get_running_loop()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._changed = asyncio.Condition()
+        listing = self._loop.create_future()
+        # (depth first key, path, future of the entries) of the
+        # directories to read
+        self._queue = [((), rootPath, listing)]
+        self._buffered = 0
+        self._awaited = ()
+        workers = [asyncio.ensure_future(self._work())
+                   for i in range(self.concurrency)]
+        try:
+            await self._write(handler, os.path.basename(rootPath), rootPath,
+                              (), listing)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    def _run(self, rootPath, handler, sort):
+        self.errors = []
+        self.pendingCalls = 0
+        self._sort = sort
+        self._diskUsage = DiskUsage() if self.diskUsage else None
+        self._executor = ThreadPoolExecutor(self.concurrency)
+        try:
+            asyncio.run(self._scan(rootPath, handler))
+        finally:
+            # do not wait for the calls timed out
+            self._executor.shutdown(wait=False)
+        errors = self.errors
+        self.errors = []
+        return errors
+
+    def scan(self, rootFolder="."):
+        """ Return the absolute path of rootFolder, the SystemTreeNode
+        tree rooted in it, the number of its nodes and the list of the
+        ScanError of the directories which could not be read.
+        """
+        absPath = os.path.abspath(rootFolder)
+        builder = TreeBuilder(self.bucketThreshold)
+        errors = []
+        for path, error in self._run(absPath, builder, False):
+            node = builder.root
+            for name in os.path.relpath(path, absPath).split(os.sep):
+                if name != os.curdir:
+                    node = node.getChild(name)
+            errors.append(ScanError(path, node, error))
+        return (absPath, builder.root, builder.nodesCount, errors)
+
+    def scanToStream(self, rootFolder, out, sort=False):
+        """ Like treestream.scanToStream: every directory is written on
+        out as soon as it and the ones before it have been read. The
+        errors are written in the stream too.
+        """
+        absPath = os.path.abspath(rootFolder)
+        flags = (SORTED if sort else 0) | (DISK_USAGE if self.diskUsage else 0)
+        writer = TreeStreamWriter(out, absPath, flags)
+        self._run(absPath, writer, sort)
+        writer.close()
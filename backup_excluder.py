@@ -4,13 +4,15 @@
 import sys
 import re
 import os
+import html
+import subprocess
 import threading
 
 try:
     from PyQt5.QtWidgets import (
         QApplication, QMainWindow, QTreeWidget, QTreeWidgetItem, QVBoxLayout,
         QPushButton, QWidget, QPlainTextEdit, QSplitter, QTextEdit, QAction,
-        QToolBar, QFileDialog, QLabel, QMenu, QAbstractItemView)
+        QToolBar, QFileDialog, QLabel, QMenu, QAbstractItemView, QLineEdit)
     from PyQt5.QtGui import QBrush, QColor, QIcon
     from PyQt5.QtCore import QObject, pyqtSignal, QCoreApplication, QSettings, QTranslator
 except ImportError:
@@ -18,14 +20,18 @@ except ImportError:
     print("pip install backup_excluder[qt]")
     raise
 
-from model import SystemTreeNode
+import commandline
+from model import (
+    SystemTreeNode, SystemTreeBucketNode, SizeIndex, NameIndex,
+    compileFilters, removePrefix)
+from excludelist import coveringSet, FORMATS
+from estimator import formatEstimate, parseRawEstimate
+from treestream import (
+    TreeStreamReader, SnapshotDiff, readSystemTree, writeSystemTree,
+    streamEntries, treeEntries, BadStreamException, SORTED, DENIED_PREFIX)
 from scripts.dirsize import humanize_bytes
 
 
-def matchNothing(ignored):
-    return False
-
-
 class SystemTreeWidgetNode(QTreeWidgetItem):
 
     percentTemplate = "{:.1%}"
@@ -34,6 +40,12 @@ class SystemTreeWidgetNode(QTreeWidgetItem):
         SystemTreeNode.PARTIALLY_INCLUDED: QBrush(QColor("yellow")),
         SystemTreeNode.FULLY_INCLUDED: QBrush(QColor("white"))
     }
+    changeBrushes = {
+        "grew": QBrush(QColor("red")),
+        "shrank": QBrush(QColor("blue")),
+        SnapshotDiff.ADDED: QBrush(QColor("darkGreen"))
+    }
+    errorBrush = QBrush(QColor("darkRed"))
 
     def __init__(self, parent, data):
         super().__init__(parent)
@@ -43,7 +55,10 @@ class SystemTreeWidgetNode(QTreeWidgetItem):
         self.setText(1, humanize_bytes(self._cutSize))
         self.setText(2, SystemTreeWidgetNode.percentTemplate.format(1))
         self.setText(3, humanize_bytes(self._uncutSize))
+        self.setText(4, humanize_bytes(data.subtreeDiskSize))
+        self._data = data
         data.visibilityChangedHandler = self._update_visibility
+        self._showScanError()
 
     def __lt__(self, other):
         col = self.treeWidget().sortColumn()
@@ -55,6 +70,8 @@ class SystemTreeWidgetNode(QTreeWidgetItem):
             return selfPercentage < otherPercentage
         elif col == 3:
             return self._uncutSize < other._uncutSize
+        elif col == 4:
+            return self._data.subtreeDiskSize < other._data.subtreeDiskSize
         else:
             return super().__lt__(other)
 
@@ -63,6 +80,7 @@ class SystemTreeWidgetNode(QTreeWidgetItem):
         self.setBackground(1, brush)
         self.setBackground(2, brush)
         self.setBackground(3, brush)
+        self.setBackground(4, brush)
 
     def _update_visibility(self, exclusionState, actualSize):
         self._cutSize = actualSize
@@ -77,6 +95,26 @@ class SystemTreeWidgetNode(QTreeWidgetItem):
                 self.child(i)._update_visibility(exclusionState, 0)
         QCoreApplication.processEvents()
 
+    def highlightChange(self, kind, oldSize, newSize):
+        """ Highlight the change of the item since a snapshot. """
+        if kind == SnapshotDiff.CHANGED:
+            kind = "grew" if newSize > oldSize else "shrank"
+        self.setForeground(0, self.changeBrushes[kind])
+        self.setToolTip(0, "{} -> {}".format(humanize_bytes(oldSize),
+                                             humanize_bytes(newSize)))
+
+    def _showScanError(self):
+        """ Show the error met reading the directory, if any. """
+        if self._data.scanError is None:
+            self.setForeground(0, QBrush())
+            self.setToolTip(0, "")
+        else:
+            self.setForeground(0, self.errorBrush)
+            self.setToolTip(0, self._data.scanError)
+
+    def clearHighlight(self):
+        self._showScanError()
+
     def getFullPath(self):
         node = self.parent()
         result = self.text(0)
@@ -85,6 +123,22 @@ class SystemTreeWidgetNode(QTreeWidgetItem):
             node = node.parent()
         return result
 
+    def isBucket(self):
+        return isinstance(self._data, SystemTreeBucketNode)
+
+    def expandBucket(self):
+        """ Replace the item of a bucket with one item per file. """
+        if not self.isBucket():
+            return
+        parent = self.parent()
+        if parent is None:
+            parent = self.treeWidget().invisibleRootItem()
+        parent.removeChild(self)
+        for child in self._data.expand():
+            item = SystemTreeWidgetNode(parent, child)
+            if child._currentExclusionState != SystemTreeNode.FULLY_INCLUDED:
+                item._update_visibility(child._currentExclusionState, 0)
+
     @staticmethod
     def fromSystemTree(parent, data):
         root = SystemTreeWidgetNode(parent, data)
@@ -96,44 +150,147 @@ class SystemTreeWidgetNode(QTreeWidgetItem):
 
 class WorkerThread(threading.Thread):
 
-    def __init__(self, mainThread, initialPath):
+    def __init__(self, mainThread, initialPath, scanFile=None):
         super().__init__()
         self.mainThread = mainThread
         self.initialPath = initialPath
+        self.scanFile = scanFile
 
     def run(self):
         callback = self.mainThread._createSystemTreeAsyncEnd
         workerObject = WorkerObject(self.mainThread)
         workerObject.moveToThread(QApplication.instance().thread())
         workerObject.workFinished.connect(callback)
-        workerObject.doWork(self.initialPath)
+        workerObject.workFailed.connect(
+            self.mainThread._createSystemTreeAsyncFailed)
+        workerObject.doWork(self.initialPath, self.scanFile)
 
 
 class WorkerObject(QObject):
 
     workFinished = pyqtSignal()
+    workFailed = pyqtSignal(str)
 
     def __init__(self, parent):
         super().__init__(None)
         self.mainThread = parent
 
-    def doWork(self, initialPath):
-        a, b, c = SystemTreeNode.createSystemTree(initialPath)
+    def _scan(self, initialPath, bucketThreshold):
+        """ Scan the file system in a separate process (the scan command
+        of commandline), decoding its output while it is produced.
+        """
+        command = [sys.executable, commandline.__file__, "scan",
+                   initialPath]
+        if self.mainThread.scanConcurrency:
+            command += ["--concurrency",
+                        str(self.mainThread.scanConcurrency)]
+        if self.mainThread.diskUsage:
+            command.append("--disk-usage")
+        scanner = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            return readSystemTree(scanner.stdout, bucketThreshold)
+        finally:
+            scanner.stdout.close()
+            scanner.wait()
+
+    def doWork(self, initialPath, scanFile=None):
+        bucketThreshold = self.mainThread.bucketThreshold or None
+        try:
+            if scanFile is None:
+                a, b, c = self._scan(initialPath, bucketThreshold)
+            else:
+                with open(scanFile, "rb") as f:
+                    a, b, c = readSystemTree(f, bucketThreshold)
+        except (BadStreamException, OSError) as err:
+            self.workFailed.emit(str(err))
+            return
         self.mainThread.basePath = a
         self.mainThread.root = b
         self.mainThread.totalNodes = c
+        self.mainThread.sizeIndex = SizeIndex(b)
+        self.mainThread.nameIndex = NameIndex(b)
         self.workFinished.emit()
 
 
+class EstimatorThread(threading.Thread):
+
+    """ Seconds between two updates of the estimate """
+    refreshInterval = 0.5
+
+    def __init__(self, mainThread, initialPath, filters=None,
+                 matchRoot=False):
+        super().__init__(daemon=True)
+        self.mainThread = mainThread
+        self.initialPath = initialPath
+        self.filters = filters
+        self.matchRoot = matchRoot
+        self.stopped = threading.Event()
+        self._process = None
+
+    def stop(self):
+        self.stopped.set()
+        process = self._process
+        if process is not None:
+            process.terminate()
+
+    def run(self):
+        """ Sample the file system in a separate process (the estimate
+        command of commandline), not to slow down the GUI and the scan
+        with the interpreter lock, until stopped.
+        """
+        estimatorObject = EstimatorObject()
+        estimatorObject.moveToThread(QApplication.instance().thread())
+        estimatorObject.estimated.connect(self.mainThread._notifyEstimate)
+        command = [sys.executable, commandline.__file__, "estimate",
+                   self.initialPath, "--updates", str(self.refreshInterval)]
+        if self.filters is not None:
+            command += ["--filters", "-"]
+        if self.matchRoot:
+            command.append("--match-root")
+        process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        self._process = process
+        if self.stopped.is_set():
+            process.terminate()
+        try:
+            process.stdin.write(self.filters or "")
+            process.stdin.close()
+            for line in process.stdout:
+                if self.stopped.is_set():
+                    break
+                estimates, probes = parseRawEstimate(line.rstrip("\n"))
+                estimatorObject.estimated.emit((self, estimates, probes))
+        except (OSError, ValueError):
+            # stopped while writing the filters, or killed
+            pass
+        finally:
+            process.terminate()
+            process.stdout.close()
+            process.wait()
+
+
+class EstimatorObject(QObject):
+
+    # (thread, (total, backup) estimates, number of probes)
+    estimated = pyqtSignal(object)
+
+
 class BackupExcluderWindow(QMainWindow):
 
     startWork = pyqtSignal(str)
+    maxReportLines = 1000
+    maxLargestItems = 100
+    maxSearchResults = 100
 
-    def __init__(self, initialPath):
+    def __init__(self, initialPath, bucketThreshold=None, concurrency=None,
+                 diskUsage=None, arrayBackend=None):
         super().__init__()
-        self._customInit(os.path.abspath(initialPath))
+        self._customInit(os.path.abspath(initialPath), bucketThreshold,
+                         concurrency, diskUsage, arrayBackend)
 
-    def _customInit(self, initialPath):
+    def _customInit(self, initialPath, bucketThreshold=None,
+                    concurrency=None, diskUsage=None, arrayBackend=None):
         super().__init__()
         tr = self.tr
 
@@ -144,18 +301,48 @@ class BackupExcluderWindow(QMainWindow):
 
         self.basePath = self.settings.value("config/basePath", initialPath)
         self.root = None
+        self.sizeIndex = None
+        self.nameIndex = None
+        self.estimator = None
+        # the filters the tree has been updated with, None if unknown
+        self.appliedFilters = None
+        self.searchEntries = []
+        self.highlighted = []
         self.totalNodes = 0
+        self.usedNodes = 0
         self.matchRoot = self.settings.value("config/matchRoot",
                                              False, type=bool)
+        if bucketThreshold is not None:
+            self.settings.setValue("config/bucketThreshold", bucketThreshold)
+        # 0 means that files are never aggregated in buckets
+        self.bucketThreshold = self.settings.value("config/bucketThreshold",
+                                                   0, type=int)
+        if concurrency is not None:
+            self.settings.setValue("config/scanConcurrency", concurrency)
+        # 0 means that the file system is scanned serially
+        self.scanConcurrency = self.settings.value("config/scanConcurrency",
+                                                   0, type=int)
+        if diskUsage is not None:
+            self.settings.setValue("config/diskUsage", diskUsage)
+        self.diskUsage = self.settings.value("config/diskUsage",
+                                             False, type=bool)
+        if arrayBackend is not None:
+            self.settings.setValue("config/arrayBackend", arrayBackend)
+        # apply the filters with the numpy backend (see arraymodel)
+        self.arrayBackend = self.settings.value("config/arrayBackend",
+                                                False, type=bool)
+        self.treeArray = None
 
         self.tree = QTreeWidget()
-        self.tree.setColumnCount(4)
+        self.tree.setColumnCount(5)
         self.tree.setHeaderLabels([
             tr("File System"),
             tr("Backup Size"),
             tr("%"),
-            tr("Full Size")])
+            tr("Full Size"),
+            tr("Disk Usage")])
         self.tree.header().resizeSection(0, 250)
+        self.tree.setColumnHidden(4, not self.diskUsage)
         self.tree.setEnabled(False)
         self.tree.setSelectionMode(QAbstractItemView.ExtendedSelection)
 
@@ -163,6 +350,33 @@ class BackupExcluderWindow(QMainWindow):
         self.output.setReadOnly(True)
         self.output.setPlaceholderText(tr("No paths matched"))
 
+        self.report = QTextEdit()
+        self.report.setReadOnly(True)
+        self.report.setPlaceholderText(tr("No report"))
+
+        self.largest = QTreeWidget()
+        self.largest.setColumnCount(3)
+        self.largest.setHeaderLabels([
+            tr("Path"),
+            tr("Backup Size"),
+            tr("Full Size")])
+        self.largest.header().resizeSection(0, 400)
+
+        self.search = QLineEdit()
+        self.search.setPlaceholderText(
+            tr("Search by name (at least {} characters)").format(
+                NameIndex.minQueryLength))
+        self.search.textChanged.connect(self._search)
+
+        self.searchResults = QTreeWidget()
+        self.searchResults.setColumnCount(3)
+        self.searchResults.setHeaderLabels([
+            tr("Path"),
+            tr("Backup Size"),
+            tr("Full Size")])
+        self.searchResults.header().resizeSection(0, 250)
+        self.searchResults.itemActivated.connect(self._revealSearchResult)
+
         self.rootFolderDisplay = QLabel()
 
         label = "<strong>{}</strong><br/>{}".format(
@@ -184,6 +398,7 @@ class BackupExcluderWindow(QMainWindow):
         self.edit = QPlainTextEdit()
         self.edit.setPlaceholderText(tr("No filters"))
         self.edit.setPlainText(self.settings.value("editor/filters"))
+        self.edit.textChanged.connect(self._filtersEdited)
 
         self.confirm = QPushButton(tr("Apply filters"))
         self.confirm.clicked.connect(self.applyFilters)
@@ -192,6 +407,8 @@ class BackupExcluderWindow(QMainWindow):
         v1.addWidget(self.rootFolderDisplay)
         v1.addWidget(self.tree)
         v1.addWidget(self.output)
+        v1.addWidget(self.report)
+        v1.addWidget(self.largest)
         leftPane = QWidget()
         leftPane.setLayout(v1)
 
@@ -201,6 +418,8 @@ class BackupExcluderWindow(QMainWindow):
         v2.addWidget(self.matchRootLabel)
         v2.addWidget(self.edit)
         v2.addWidget(self.confirm)
+        v2.addWidget(self.search)
+        v2.addWidget(self.searchResults)
         v2.addStretch(1)
         rightPane = QWidget()
         rightPane.setLayout(v2)
@@ -223,6 +442,10 @@ class BackupExcluderWindow(QMainWindow):
         moreInfo = tr("(refresh to show tree)")
         self._update_basePath(self.basePath + os.sep, moreInfo)
         self.confirm.setEnabled(False)
+        self.compare.setEnabled(False)
+        self.attribution.setEnabled(False)
+        self.saveSnapshot.setEnabled(False)
+        self.compareSnapshot.setEnabled(False)
 
         self.show()
 
@@ -235,6 +458,11 @@ class BackupExcluderWindow(QMainWindow):
             openIcon, tr("Select root folder"), self)
         openAction.triggered.connect(self._selectRootFolder)
 
+        openScanIcon = QIcon.fromTheme("document-open")
+        openScanAction = QAction(
+            openScanIcon, tr("Open file system scan"), self)
+        openScanAction.triggered.connect(self._openScanFile)
+
         saveIcon = QIcon.fromTheme("document-save")
         saveAction = QAction(
             saveIcon, tr("Save excluded paths"), self)
@@ -255,6 +483,28 @@ class BackupExcluderWindow(QMainWindow):
             listviewIcon, tr("Excluded paths list view"), self, checkable=True)
         listviewAction.triggered.connect(self._showListView)
 
+        reportviewIcon = QIcon.fromTheme("x-office-document")
+        reportviewAction = QAction(
+            reportviewIcon, tr("Report view"), self, checkable=True)
+        reportviewAction.triggered.connect(self._showReportView)
+
+        largestviewIcon = QIcon.fromTheme("view-sort-descending")
+        largestviewAction = QAction(
+            largestviewIcon, tr("Largest items to backup view"), self,
+            checkable=True)
+        largestviewAction.triggered.connect(self._showLargestView)
+
+        compareIcon = QIcon.fromTheme("edit-find-replace")
+        compareAction = QAction(
+            compareIcon, tr("Compare filter sets"), self)
+        compareAction.triggered.connect(self.compareFilterSets)
+
+        attributionIcon = QIcon.fromTheme("utilities-system-monitor")
+        attributionAction = QAction(
+            attributionIcon, tr("Report excluded size and cost per filter"),
+            self)
+        attributionAction.triggered.connect(self.attributeFilters)
+
         matchFromRootIcon = QIcon.fromTheme("tools-check-spelling")
         matchFromRootAction = QAction(
             matchFromRootIcon, tr("Include/exclude root path from match"),
@@ -262,45 +512,253 @@ class BackupExcluderWindow(QMainWindow):
         matchFromRootAction.setChecked(self.matchRoot)
         matchFromRootAction.triggered.connect(self._toggle_match_root)
 
+        saveSnapshotIcon = QIcon.fromTheme("camera-photo")
+        saveSnapshotAction = QAction(
+            saveSnapshotIcon, tr("Save snapshot"), self)
+        saveSnapshotAction.triggered.connect(self._saveSnapshot)
+
+        compareSnapshotIcon = QIcon.fromTheme("view-history")
+        compareSnapshotAction = QAction(
+            compareSnapshotIcon, tr("Compare with snapshot"), self)
+        compareSnapshotAction.triggered.connect(self._compareSnapshot)
+
         excludeFolderIcon = QIcon.fromTheme("user-trash")
         excludeFolderAction = QAction(
             excludeFolderIcon, tr("Exclude item"), self)
         excludeFolderAction.triggered.connect(self._exclude_item)
 
+        includeItemIcon = QIcon.fromTheme("edit-undo")
+        includeItemAction = QAction(
+            includeItemIcon, tr("Include item"), self)
+        includeItemAction.triggered.connect(self._include_item)
+
+        expandBucketIcon = QIcon.fromTheme("list-add")
+        expandBucketAction = QAction(
+            expandBucketIcon, tr("Show files one by one"), self)
+        expandBucketAction.triggered.connect(self._expand_bucket)
+
         manageToolBar = QToolBar()
         manageToolBar.addAction(openAction)
+        manageToolBar.addAction(openScanAction)
         manageToolBar.addAction(saveAction)
         manageToolBar.addAction(refreshAction)
         manageToolBar.addAction(matchFromRootAction)
+        manageToolBar.addAction(compareAction)
+        manageToolBar.addAction(attributionAction)
+        manageToolBar.addAction(saveSnapshotAction)
+        manageToolBar.addAction(compareSnapshotAction)
         viewToolBar = QToolBar()
         viewToolBar.addAction(treeviewAction)
         viewToolBar.addAction(listviewAction)
+        viewToolBar.addAction(reportviewAction)
+        viewToolBar.addAction(largestviewAction)
 
         self.addToolBar(manageToolBar)
         self.addToolBar(viewToolBar)
         self.insertToolBarBreak(manageToolBar)
         self.treeview = treeviewAction
         self.listview = listviewAction
+        self.reportview = reportviewAction
+        self.largestview = largestviewAction
+        self.compare = compareAction
+        self.attribution = attributionAction
         self.save = saveAction
         self.open = openAction
+        self.openScan = openScanAction
+        self.saveSnapshot = saveSnapshotAction
+        self.compareSnapshot = compareSnapshotAction
         self.refresh = refreshAction
         self.exclude = excludeFolderAction
-
-    def _exclude_item(self, boh):
+        self.include = includeItemAction
+        self.expandBucket = expandBucketAction
+
+    def _itemFilter(self, item):
+        """ Return the filter matching exactly the path of item, or None
+        if item has no path of its own.
+        """
+        if item.isBucket():
+            # a bucket has no path of its own: expand it to
+            # exclude the single files
+            return None
         if self.matchRoot:
             basePath = self.basePath
         else:
             basePath = ""
-        items = self.tree.selectedItems()
+        treePath = item.getFullPath()
+        # we want to remove the root from the path, because it is
+        # not used for matching. +1 becasue of the separator.
+        if treePath.startswith(self.root.name):
+            treePath = treePath[len(self.root.name)+1:]
+        if not treePath:
+            return None
+        return re.escape(os.path.join(basePath, treePath)) + "$"
+
+    def _forgetExcludedPaths(self, paths):
+        """ Remove paths and their descendants from the list of the
+        excluded paths.
+        """
+        prefixes = tuple(os.path.join(path, "") for path in paths)
+        paths = set(paths)
+        lines = self.output.document().toPlainText().split("\n")
+        lines = [line for line in lines
+                 if line and line not in paths
+                 and not line.startswith(prefixes)]
+        self.output.setPlainText("\n".join(lines))
+
+    def _filtersEdited(self):
+        self.filtersValidLabel.setVisible(
+            self.edit.document().toPlainText() != self.appliedFilters)
+
+    def _updateItems(self, items, text):
+        """ Apply the filters in text (the applied ones plus or minus
+        the filters of items) only to the subtrees of items, assuming
+        that the other paths are matched as before.
+        """
+        cutFunction = self._compileFilters(text)
+        if cutFunction is None:
+            message = self.tr("ERROR: bad format for regex.")
+            self._notifyStatus(message)
+            return
+        self.appliedFilters = text
+        self.settings.setValue("editor/filters", text)
+        self.filtersValidLabel.setVisible(False)
+        hiddenPath = os.path.dirname(self.basePath)
+        self._forgetExcludedPaths(
+            [item._data.getFullPath(hiddenPath) for item in items])
+        # the states are changed without the array
+        self.treeArray = None
+        for item in items:
+            sizeChange, nodesChange = item._data.updateSubtree(
+                hiddenPath, cutFunction)
+            self.usedNodes += nodesChange
+        self._updateLargest()
+        self._search(self.search.text())
+        self._notifyBackupStatus(self.root.subtreeCutSize, self.usedNodes)
+
+    def _selectedTopmostItems(self):
+        """ Return the selected items with no selected ancestors. """
+        selected = self.tree.selectedItems()
+        items = []
+        for item in selected:
+            node = item.parent()
+            while node is not None and not node.isSelected():
+                node = node.parent()
+            if node is None:
+                items.append(item)
+        return items
+
+    def _editItemFilters(self, items, text):
+        """ Put text in the editor and update the tree with it: only
+        the subtrees of items if the editor held the applied filters,
+        the whole tree otherwise.
+        """
+        applied = (self.edit.document().toPlainText() ==
+                   self.appliedFilters)
+        self.edit.setPlainText(text)
+        if applied:
+            self._updateItems(items, text)
+        else:
+            self.applyFilters(None)
+
+    def _exclude_item(self, boh):
+        items = []
+        text = self.edit.document().toPlainText()
+        lines = set(text.split("\n"))
+        for item in self._selectedTopmostItems():
+            itemFilter = self._itemFilter(item)
+            if itemFilter is not None:
+                if itemFilter not in lines:
+                    lines.add(itemFilter)
+                    if text and not text.endswith("\n"):
+                        text += "\n"
+                    text += itemFilter
+                items.append(item)
+        self._editItemFilters(items, text)
+
+    def _include_item(self, boh):
+        items = []
+        itemFilters = set()
+        for item in self._selectedTopmostItems():
+            itemFilter = self._itemFilter(item)
+            if itemFilter is not None:
+                itemFilters.add(itemFilter)
+                items.append(item)
+        lines = self.edit.document().toPlainText().split("\n")
+        self._editItemFilters(items, "\n".join(
+            line for line in lines if line not in itemFilters))
+        if any(item._data.exclusionState != SystemTreeNode.FULLY_INCLUDED
+               for item in items):
+            self._notifyStatus(self.tr(
+                "Some items are still excluded by other filters."))
+
+    def _expand_bucket(self, boh):
+        items = [i for i in self.tree.selectedItems() if i.isBucket()]
         for item in items:
-            treePath = item.getFullPath()
-            # we want to remove the root from the path, because it is
-            # not used for matching. +1 becasue of the separator.
-            if treePath.startswith(self.root.name):
-                treePath = treePath[len(self.root.name)+1:]
-            path = os.path.join(basePath, treePath)
-            self.edit.appendPlainText(path)
-        self.applyFilters(None)
+            item.expandBucket()
+        if items:
+            self.treeArray = None
+            self._rebuildIndexes()
+
+    def _rebuildIndexes(self):
+        """ Rebuild the indexes after some buckets in them have been
+        replaced by their files.
+        """
+        self.sizeIndex = SizeIndex(self.root)
+        self.nameIndex = NameIndex(self.root)
+        self._updateLargest()
+        self._search(self.search.text())
+
+    def _search(self, text):
+        self.searchResults.clear()
+        self.searchEntries = []
+        if self.nameIndex is None:
+            return
+        if 0 < len(text) < NameIndex.minQueryLength:
+            self._notifyStatus(self.tr(
+                "Type at least {} characters to search.").format(
+                    NameIndex.minQueryLength))
+            return
+        hiddenPath = os.path.dirname(self.basePath)
+        self.searchEntries = self.nameIndex.search(text,
+                                                   self.maxSearchResults)
+        for node, member in self.searchEntries:
+            path, cutSize, fullSize = NameIndex.describe(node, member,
+                                                         hiddenPath)
+            QTreeWidgetItem(self.searchResults, [
+                path, humanize_bytes(cutSize), humanize_bytes(fullSize)])
+
+    def _revealSearchResult(self, resultItem, column):
+        """ Select the item of the tree view corresponding to the search
+        result, expanding its bucket if needed.
+        """
+        index = self.searchResults.indexOfTopLevelItem(resultItem)
+        node, member = self.searchEntries[index]
+        chain = []
+        while node is not None:
+            chain.append(node)
+            node = node.parent
+        item = None
+        for node in reversed(chain):
+            if item is None:
+                children = [self.tree.topLevelItem(i)
+                            for i in range(self.tree.topLevelItemCount())]
+            else:
+                children = [item.child(i) for i in range(item.childCount())]
+            item = next((c for c in children if c._data is node), None)
+            if item is None:
+                return False
+        if member >= 0:
+            name = item._data.names[member]
+            parent = item.parent()
+            item.expandBucket()
+            self._rebuildIndexes()
+            item = next(parent.child(i) for i in range(parent.childCount())
+                        if parent.child(i).text(0) == name)
+        self._showTreeView()
+        self.tree.clearSelection()
+        self.tree.setCurrentItem(item)
+        self.tree.scrollToItem(item)
+        return True
 
     def contextMenuEvent(self, event):
         if event.reason() == event.Mouse:
@@ -312,6 +770,9 @@ class BackupExcluderWindow(QMainWindow):
             return
         contextMenu = QMenu(self.tree)
         contextMenu.addAction(self.exclude)
+        contextMenu.addAction(self.include)
+        if any(i.isBucket() for i in item):
+            contextMenu.addAction(self.expandBucket)
         contextMenu.popup(pos)
         event.accept()
 
@@ -329,31 +790,78 @@ class BackupExcluderWindow(QMainWindow):
             self.tr("Size"), humanize_bytes(finalSize), usedNodes,
             self.totalNodes, self.tr("Items to backup")))
 
+    def _notifyEstimate(self, update):
+        thread, (total, backup), probes = update
+        if thread is not self.estimator:
+            # late update of an estimator already stopped
+            return
+        self._notifyStatus("{} {}: {}, {}: {} ({} {})".format(
+            self.tr("Scanning..."), self.tr("Estimated size"),
+            formatEstimate(total), self.tr("to backup"),
+            formatEstimate(backup), probes, self.tr("samples")))
+
+    def _stopEstimator(self):
+        if self.estimator is not None:
+            self.estimator.stop()
+            self.estimator = None
+
     def _clear_widgets(self):
         self.tree.clear()
+        self.highlighted = []
+        self.searchResults.clear()
+        self.searchEntries = []
         self.output.clear()
+        self.largest.clear()
+        self.appliedFilters = None
         self.filtersValidLabel.setVisible(True)
 
     def _setOutputEnabled(self, enabled):
         self.tree.setEnabled(enabled)
         self.output.setEnabled(enabled)
         self.confirm.setEnabled(enabled)
+        self.compare.setEnabled(enabled)
+        self.attribution.setEnabled(enabled)
+        self.saveSnapshot.setEnabled(enabled)
+        self.compareSnapshot.setEnabled(enabled)
         self.refresh.setEnabled(enabled)
         self.open.setEnabled(enabled)
+        self.openScan.setEnabled(enabled)
         self.save.setEnabled(enabled)
 
     def _createSystemTree(self, initialPath):
         self._createSystemTreeAsyncStart(initialPath)
 
-    def _createSystemTreeAsyncStart(self, initialPath):
+    def _createSystemTreeAsyncStart(self, initialPath, scanFile=None):
         self._notifyStatus(self.tr(
             "Please wait...scanning file system. It may take a while."))
         self._setOutputEnabled(False)
         self._clear_widgets()
-        worker = WorkerThread(self, initialPath)
+        self.treeArray = None
+        self._stopEstimator()
+        if scanFile is None:
+            # the filters of the previous tree, if any, are anchored
+            # to its base path
+            filters = None
+            text = self.edit.document().toPlainText()
+            if (self.basePath == os.path.abspath(initialPath) and
+                    self._compileFilters(text) is not None):
+                filters = text
+            self.estimator = EstimatorThread(self, initialPath, filters,
+                                             self.matchRoot)
+            self.estimator.start()
+        worker = WorkerThread(self, initialPath, scanFile)
         worker.start()
 
+    def _createSystemTreeAsyncFailed(self, message):
+        self._stopEstimator()
+        self._notifyStatus("{}: {}".format(
+            self.tr("ERROR: the file system could not be read"), message))
+        self.refresh.setEnabled(True)
+        self.open.setEnabled(True)
+        self.openScan.setEnabled(True)
+
     def _createSystemTreeAsyncEnd(self):
+        self._stopEstimator()
         self._notifyStatus(self.tr(
             "Please wait...populating tree view. It may take a while."))
         self.tree.setSortingEnabled(False)
@@ -364,7 +872,13 @@ class BackupExcluderWindow(QMainWindow):
             "Please wait...connecting tree view. It may take a while."))
         self._listen_for_excluded_paths(self.root)
         self._update_basePath(self.basePath + os.sep)
+        self.usedNodes = self.totalNodes
+        # a new tree is not pruned
+        self.appliedFilters = ""
+        self._filtersEdited()
         self._notifyBackupStatus(self.root.subtreeTotalSize, self.totalNodes)
+        self._updateLargest()
+        self._search(self.search.text())
         self._setOutputEnabled(True)
 
     def _selectRootFolder(self):
@@ -377,34 +891,190 @@ class BackupExcluderWindow(QMainWindow):
             return True
         return False
 
+    def _saveSnapshot(self):
+        fileName, fileExtension = QFileDialog.getSaveFileName(
+            self, self.tr("Save snapshot"), "",
+            "File system scan (*.bex);;All Files (*)")
+        if not fileName:
+            return False
+        with open(fileName, "wb") as f:
+            writeSystemTree(self.root, self.basePath, f, sort=True,
+                            diskUsage=self.diskUsage)
+        return True
+
+    def _itemsByPath(self):
+        """ Return the items of the tree view by path, relative to the
+        root and named like in treeEntries. The paths of the files in a
+        bucket give the item of the bucket.
+        """
+        items = {}
+        stack = [(self.tree.topLevelItem(i), None)
+                 for i in range(self.tree.topLevelItemCount())]
+        while stack:
+            item, parentPath = stack.pop()
+            if item.isBucket():
+                for name in item._data.names:
+                    items[os.path.join(parentPath, name)] = item
+                continue
+            if parentPath is None:
+                path = ""
+            else:
+                path = os.path.join(parentPath, removePrefix(
+                    item._data.name, DENIED_PREFIX))
+            items[path] = item
+            stack.extend((item.child(i), path)
+                         for i in range(item.childCount()))
+        return items
+
+    def _compareSnapshot(self):
+        """ Highlight what changed since the snapshot chosen by the user
+        and report the change of the backup size with the filters in
+        the editor.
+        """
+        fileName, fileExtension = QFileDialog.getOpenFileName(
+            self, self.tr("Compare with snapshot"), "",
+            "File system scan (*.bex);;All Files (*)")
+        if not fileName:
+            return False
+        cutFunction = self._compileFilters(self.edit.document().toPlainText())
+        if cutFunction is None:
+            self._notifyStatus(self.tr("ERROR: bad format for regex."))
+            return False
+        for item in self.highlighted:
+            item.clearHighlight()
+        self.highlighted = []
+        items = self._itemsByPath()
+        removed = []
+        try:
+            with open(fileName, "rb") as f:
+                reader = TreeStreamReader(f)
+                if not reader.flags & SORTED:
+                    raise BadStreamException(self.tr("not a snapshot"))
+                diff = SnapshotDiff(streamEntries(reader),
+                                    treeEntries(self.root), cutFunction,
+                                    self.basePath)
+                # id of a bucket item -> [item, old size, new size] of
+                # its files which changed
+                bucketChanges = {}
+                for kind, path, oldSize, newSize in diff.changes():
+                    item = items.get(path)
+                    if kind == SnapshotDiff.REMOVED:
+                        # an item at path is of another kind now
+                        removed.append((path, oldSize))
+                    elif item is not None and item.isBucket():
+                        change = bucketChanges.setdefault(
+                            id(item), [item, 0, 0])
+                        change[1] += oldSize
+                        change[2] += newSize
+                    elif item is not None:
+                        item.highlightChange(kind, oldSize, newSize)
+                        self.highlighted.append(item)
+                for item, oldSize, newSize in bucketChanges.values():
+                    item.highlightChange(SnapshotDiff.CHANGED, oldSize,
+                                         newSize)
+                    self.highlighted.append(item)
+        except (BadStreamException, OSError) as err:
+            self._notifyStatus("{}: {}".format(
+                self.tr("ERROR: the snapshot could not be read"), err))
+            return False
+        lines = ["<strong>{}</strong>".format(self.tr("Removed"))]
+        removed.sort(key=lambda r: r[1], reverse=True)
+        for path, size in removed[:self.maxReportLines]:
+            lines.append("{} ({})".format(html.escape(path),
+                                          humanize_bytes(size)))
+        self.report.setHtml("<br/>".join(lines))
+        self._notifyStatus("{}: {} -> {}, {}: {} -> {}".format(
+            self.tr("Since snapshot size"),
+            humanize_bytes(diff.totalSizes[0]),
+            humanize_bytes(diff.totalSizes[1]),
+            self.tr("backup size"),
+            humanize_bytes(diff.backupSizes[0]),
+            humanize_bytes(diff.backupSizes[1])))
+        return True
+
+    def _openScanFile(self):
+        fileName, fileExtension = QFileDialog.getOpenFileName(
+            self, self.tr("Open file system scan"), "",
+            "File system scan (*.bex);;All Files (*)")
+        if fileName:
+            self._createSystemTreeAsyncStart(None, fileName)
+            return True
+        return False
+
     def _saveToFile(self):
+        formats = [
+            ("Paths excluded list (*.pel)", None),
+            ("rsync exclude list (*.rsync)", "rsync"),
+            ("tar exclude list (*.tar-exclude)", "tar"),
+            ("borg patterns (*.borg)", "borg"),
+            ("All Files (*)", None)]
         fileName, fileExtension = QFileDialog.getSaveFileName(
             self, self.tr("Save excluded paths list"), "",
-            "Paths excluded list (*.pel);;All Files (*)")
+            ";;".join(f for f, exportFormat in formats))
         if not fileName:
             return False
+        exportFormat = dict(formats).get(fileExtension)
+        if exportFormat is None:
+            text = self.output.document().toPlainText()
+        else:
+            # the minimal list of paths and patterns excluding the
+            # same items, not every path matching the filters
+            text = FORMATS[exportFormat](coveringSet(self.root),
+                                         self.basePath)
         with open(fileName, "w+") as f:
-            f.write(self.output.document().toPlainText())
+            f.write(text)
 
     def _refreshFileSystem(self):
         self._createSystemTree(self.basePath)
 
+    def _showView(self, view):
+        views = [
+            (self.tree, self.treeview),
+            (self.output, self.listview),
+            (self.report, self.reportview),
+            (self.largest, self.largestview)]
+        for widget, action in views:
+            widget.setVisible(widget is view)
+            action.setChecked(widget is view)
+
     def _showTreeView(self):
-        self.tree.setVisible(True)
-        self.output.setVisible(False)
-        self.treeview.setChecked(True)
-        self.listview.setChecked(False)
+        self._showView(self.tree)
 
     def _showListView(self):
-        self.tree.setVisible(False)
-        self.output.setVisible(True)
-        self.treeview.setChecked(False)
-        self.listview.setChecked(True)
+        self._showView(self.output)
+
+    def _showReportView(self):
+        self._showView(self.report)
+
+    def _showLargestView(self):
+        self._showView(self.largest)
+
+    def _updateLargest(self):
+        """ Show the largest files and directories still included. """
+        self.largest.clear()
+        if self.sizeIndex is None:
+            return
+        hiddenPath = os.path.dirname(self.basePath)
+        sections = [
+            (self.tr("Directories"), True),
+            (self.tr("Files"), False)]
+        for label, directories in sections:
+            section = QTreeWidgetItem(self.largest, [label])
+            for node in self.sizeIndex.largest(self.maxLargestItems,
+                                               directories):
+                QTreeWidgetItem(section, [
+                    node.getFullPath(hiddenPath),
+                    humanize_bytes(node.subtreeCutSize),
+                    humanize_bytes(node.subtreeTotalSize)])
+        self.largest.expandToDepth(0)
 
     def _toggle_match_root(self):
         self.matchRoot = not self.matchRoot
         self.settings.setValue("config/matchRoot", self.matchRoot)
         self.matchRootLabel.setVisible(self.matchRoot)
+        # the filters match other paths now
+        self.appliedFilters = None
+        self.filtersValidLabel.setVisible(True)
         message = self.tr(
             "Switched to {} root path. Views are NOT updated. Apply filters again.")
         if self.matchRoot:
@@ -421,45 +1091,174 @@ class BackupExcluderWindow(QMainWindow):
         for child in root.children.values():
             self._listen_for_excluded_paths(child)
 
+    def _compileFilters(self, text):
+        """ Return the cut function matching the filters in text, or
+        None if the filters are not valid regular expressions.
+        """
+        if self.matchRoot:
+            base = ""
+        else:
+            base = self.basePath + os.sep
+        try:
+            return compileFilters(text.split("\n"), base)
+        except re.error:
+            return None
+
+    def _treeArray(self):
+        """ Return the SystemTreeArray mirroring the tree, built the
+        first time, or None if numpy is not available.
+        """
+        if self.treeArray is None:
+            try:
+                from arraymodel import SystemTreeArray
+            except ImportError:
+                return None
+            self.treeArray = SystemTreeArray.fromSystemTree(
+                self.root, os.path.dirname(self.basePath))
+        return self.treeArray
+
     def applyFilters(self, sender):
         self._notifyStatus(self.tr(
             "Please wait...applying filters. It may take a while."))
         self.output.document().clear()
         text = self.edit.document().toPlainText()
         self.settings.setValue("editor/filters", text)
-        filters = list(filter(str.strip, text.split("\n")))
-        if len(filters) > 0:
-            if self.matchRoot:
-                base = ""
-            else:
-                base = self.basePath + os.sep
-            filterExpr = base + '(' + '|'.join(filters) + ')'
-            try:
-                cutFunction = re.compile(filterExpr).match
-            except Exception:
-                message = self.tr("ERROR: bad format for regex.")
-                self._notifyStatus(message)
-                return
-        else:
-            cutFunction = matchNothing
+        cutFunction = self._compileFilters(text)
+        if cutFunction is None:
+            message = self.tr("ERROR: bad format for regex.")
+            self._notifyStatus(message)
+            return
+        self.appliedFilters = text
         hiddenPath = os.path.dirname(self.basePath)
         self.confirm.setEnabled(False)
-        finalSize, nodesCount = self.root.update(hiddenPath, cutFunction)
+        tree = self._treeArray() if self.arrayBackend else None
+        if tree is not None:
+            finalSize, nodesCount = tree.update(cutFunction)
+            tree.syncSystemTree()
+        else:
+            finalSize, nodesCount = self.root.update(hiddenPath, cutFunction)
+        self.usedNodes = nodesCount
         self.filtersValidLabel.setVisible(False)
         self.confirm.setEnabled(True)
+        self._updateLargest()
+        self._search(self.search.text())
         self._notifyBackupStatus(finalSize, nodesCount)
 
+    def compareFilterSets(self, sender):
+        """ Compare the filters in the editor with the filter sets saved
+        in the files chosen by the user, in a single traversal.
+        """
+        fileNames, fileExtension = QFileDialog.getOpenFileNames(
+            self, self.tr("Select filter sets to compare"), "",
+            "Filters list (*.txt);;All Files (*)")
+        if not fileNames:
+            return False
+        labels = [self.tr("Current filters")]
+        cutFunctions = [self._compileFilters(
+            self.edit.document().toPlainText())]
+        for fileName in fileNames:
+            with open(fileName) as f:
+                cutFunctions.append(self._compileFilters(f.read()))
+            labels.append(os.path.basename(fileName))
+        if None in cutFunctions:
+            message = self.tr("ERROR: bad format for regex in {}.")
+            self._notifyStatus(message.format(
+                labels[cutFunctions.index(None)]))
+            return False
+        self._notifyStatus(self.tr(
+            "Please wait...comparing filter sets. It may take a while."))
+        hiddenPath = os.path.dirname(self.basePath)
+        sizes, nodes, differences = self.root.compare(hiddenPath,
+                                                      cutFunctions)
+        lines = ["<strong>{}</strong>".format(self.tr("Filter sets"))]
+        for label, size, count in zip(labels, sizes, nodes):
+            lines.append("{}: {} ({}/{} {})".format(
+                label, humanize_bytes(size), count, self.totalNodes,
+                self.tr("Items to backup")))
+        lines.append("<br/><strong>{}</strong>".format(
+            self.tr("Differing subtrees")))
+        differences.sort(key=lambda d: d[1], reverse=True)
+        for path, size, excluding in differences[:self.maxReportLines]:
+            lines.append("{} ({}): {} {}".format(
+                path, humanize_bytes(size), self.tr("excluded by"),
+                ", ".join(labels[i] for i in excluding)))
+        self.report.setHtml("<br/>".join(lines))
+        self._showReportView()
+        self._notifyStatus(self.tr("Filter sets compared."))
+        return True
+
+    def attributeFilters(self, sender):
+        """ Report, for every line of the filters in the editor, the
+        bytes and items it excludes and the time spent matching it.
+        """
+        text = self.edit.document().toPlainText()
+        filters = list(filter(str.strip, text.split("\n")))
+        cutFunctions = [self._compileFilters(line) for line in filters]
+        if None in cutFunctions:
+            message = self.tr("ERROR: bad format for regex.")
+            self._notifyStatus(message)
+            return False
+        self._notifyStatus(self.tr(
+            "Please wait...measuring filters. It may take a while."))
+        hiddenPath = os.path.dirname(self.basePath)
+        stats = self.root.attribute(hiddenPath, cutFunctions)
+        header = [self.tr("Filter"), self.tr("Excluded (first match)"),
+                  self.tr("Excluded (only match)"), self.tr("Tests"),
+                  self.tr("Time")]
+        rows = ["<tr>" + "".join("<th>{}</th>".format(h) for h in header) +
+                "</tr>"]
+        for line, stat in zip(filters, stats):
+            cells = [
+                html.escape(line),
+                "{} ({})".format(humanize_bytes(stat.firstMatchSize),
+                                 stat.firstMatchNodes),
+                "{} ({})".format(humanize_bytes(stat.exclusiveSize),
+                                 stat.exclusiveNodes),
+                str(stat.tests),
+                "{:.1f} ms".format(stat.elapsed * 1000)]
+            if stat.exclusiveNodes == 0:
+                cells[0] = "<span style='color:red'>{}</span>".format(
+                    cells[0])
+            rows.append("<tr>" + "".join(
+                "<td>{}</td>".format(c) for c in cells) + "</tr>")
+        self.report.setHtml("<table>{}</table>".format("".join(rows)))
+        self._showReportView()
+        self._notifyStatus(self.tr(
+            "Filters measured. Filters in red do not exclude anything "
+            "that the other filters do not exclude too."))
+        return True
+
 
 def main():
     import argparse
     parser = argparse.ArgumentParser(description='backup excluder')
     parser.add_argument('start', nargs='?', default='.')
+    parser.add_argument('-b', '--bucket-threshold', type=int,
+                        help='aggregate the files of directories with more '
+                             'files than this (0 to disable)')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        help='read up to this many directories and files '
+                             'at the same time, for network file systems '
+                             '(0 to scan serially)')
+    parser.add_argument('-u', '--disk-usage', action='store_const',
+                        const=True,
+                        help='show the space allocated on disk, counting '
+                             'hard links once')
+    parser.add_argument('--no-disk-usage', action='store_const',
+                        const=False, dest='disk_usage')
+    parser.add_argument('--numpy', action='store_const', const=True,
+                        dest='array_backend',
+                        help='apply the filters with the numpy backend')
+    parser.add_argument('--no-numpy', action='store_const', const=False,
+                        dest='array_backend')
     args = parser.parse_args()
 
     app = QApplication(sys.argv)
     translator = QTranslator()
     app.installTranslator(translator)
-    window = BackupExcluderWindow(args.start)
+    window = BackupExcluderWindow(args.start, args.bucket_threshold,
+                                  args.concurrency, args.disk_usage,
+                                  args.array_backend)
     retVal = app.exec_()
     del window
     del app
@@ -0,0 +1,246 @@
+import os
+import sys
+
+import treestream
+import excludelist
+from model import SystemTreeNode, SizeIndex, compileFilters
+from asyncscan import AsyncScanner
+from estimator import SizeEstimator, formatEstimate, formatRawEstimate
+from scripts.dirsize import humanize_bytes
+
+
+def _loadTree(args):
+    if args.input:
+        with open(args.input, "rb") as f:
+            if args.disk_usage and not (treestream.TreeStreamReader(f).flags
+                                        & treestream.DISK_USAGE):
+                raise SystemExit("{} has no disk usage (scan --disk-usage)"
+                                 .format(args.input))
+            f.seek(0)
+            basePath, root, nodesCount = treestream.readSystemTree(
+                f, args.bucket_threshold)
+    else:
+        basePath, root, nodesCount = SystemTreeNode.createSystemTree(
+            args.start, args.bucket_threshold, args.disk_usage)
+    filters = []
+    if args.filters:
+        with open(args.filters) as f:
+            filters = f.read().split("\n")
+    cutPath = compileFilters(filters, basePath + os.sep)
+    if args.numpy:
+        from arraymodel import SystemTreeArray
+        tree = SystemTreeArray.fromSystemTree(root, os.path.dirname(basePath))
+        tree.update(cutPath)
+        tree.syncSystemTree()
+    else:
+        root.update(os.path.dirname(basePath), cutPath)
+    return (basePath, root, nodesCount)
+
+
+def _printLargest(args):
+    basePath, root, nodesCount = _loadTree(args)
+    index = SizeIndex(root)
+    hiddenPath = os.path.dirname(basePath)
+    for node in index.largest(args.count, args.directories, not args.full):
+        sizes = [node.subtreeCutSize, node.subtreeTotalSize]
+        if args.disk_usage:
+            sizes.append(node.subtreeDiskSize)
+        print("\t".join([humanize_bytes(size) for size in sizes] +
+                        [node.getFullPath(hiddenPath)]))
+
+
+def _printExcludeList(args):
+    basePath, root, nodesCount = _loadTree(args)
+    entries = excludelist.coveringSet(root, args.min_glob)
+    text = excludelist.FORMATS[args.format](entries, basePath)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text, end="")
+
+
+def _scanTo(args, out):
+    """ Scan to out and return the number of calls of the concurrent
+    scan still blocked in the file system.
+    """
+    if not args.concurrency:
+        treestream.scanToStream(args.start, out, args.sort, args.disk_usage)
+        return 0
+    scanner = AsyncScanner(args.concurrency, args.timeout, args.retries,
+                           diskUsage=args.disk_usage)
+    scanner.scanToStream(args.start, out, args.sort)
+    return scanner.pendingCalls
+
+
+def _scan(args):
+    if args.output:
+        with open(args.output, "wb") as f:
+            pendingCalls = _scanTo(args, f)
+    else:
+        pendingCalls = _scanTo(args, sys.stdout.buffer)
+    if pendingCalls:
+        # the threads of the calls timed out may never return (e.g., on
+        # a hung mount) and the interpreter would wait for them at exit
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+
+def _printEstimate(args):
+    basePath = os.path.abspath(args.start)
+    filters = []
+    if args.filters == "-":
+        filters = sys.stdin.read().split("\n")
+    elif args.filters:
+        with open(args.filters) as f:
+            filters = f.read().split("\n")
+    cutPath = compileFilters(filters, "" if args.match_root
+                             else basePath + os.sep)
+    estimator = SizeEstimator(basePath, cutPath, args.seed)
+    if args.updates:
+        try:
+            # until the process is stopped
+            while True:
+                estimator.refine(args.updates)
+                print(formatRawEstimate(estimator.estimate(),
+                                        estimator.probes), flush=True)
+        except BrokenPipeError:
+            return
+    estimator.refine(args.time, args.probes)
+    total, backup = estimator.estimate()
+    print("Total:\t{}".format(formatEstimate(total)))
+    print("Backup:\t{}".format(formatEstimate(backup)))
+    print("Probes:\t{}".format(estimator.probes))
+
+
+def _signedBytes(size):
+    return ("+" if size >= 0 else "-") + humanize_bytes(abs(size))
+
+
+def _printSnapshotDiff(args):
+    with open(args.old, "rb") as oldFile, open(args.new, "rb") as newFile:
+        old = treestream.TreeStreamReader(oldFile)
+        new = treestream.TreeStreamReader(newFile)
+        for reader, fileName in [(old, args.old), (new, args.new)]:
+            if not reader.flags & treestream.SORTED:
+                raise SystemExit("{} is not a snapshot (scan --sort)".format(
+                    fileName))
+        filters = []
+        if args.filters:
+            with open(args.filters) as f:
+                filters = f.read().split("\n")
+        cutPath = compileFilters(filters, new.rootPath + os.sep)
+        diff = treestream.SnapshotDiff(
+            treestream.streamEntries(old), treestream.streamEntries(new),
+            cutPath, new.rootPath)
+        for kind, path, oldSize, newSize in diff.changes():
+            if abs(newSize - oldSize) >= args.min_change:
+                print("{}\t{}\t{}".format(
+                    kind, _signedBytes(newSize - oldSize),
+                    os.path.join(new.rootPath, path) if path
+                    else new.rootPath))
+    for label, sizes in [("total", diff.totalSizes),
+                         ("backup", diff.backupSizes)]:
+        print("{}\t{}\t{} -> {}".format(
+            label, _signedBytes(sizes[1] - sizes[0]),
+            humanize_bytes(sizes[0]), humanize_bytes(sizes[1])))
+
+
+def main():
+    import argparse
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('start', nargs='?', default='.')
+    common.add_argument('-f', '--filters',
+                        help='file with the filters, one regex per line')
+    common.add_argument('-b', '--bucket-threshold', type=int,
+                        help='aggregate the files of directories with '
+                             'more files than this')
+    common.add_argument('-i', '--input',
+                        help='read the tree from a scan file instead of '
+                             'the file system')
+    common.add_argument('--numpy', action='store_true',
+                        help='compute the sizes with the numpy backend')
+    common.add_argument('-u', '--disk-usage', action='store_true',
+                        help='also print the space allocated on disk, '
+                             'counting hard links once')
+    parser = argparse.ArgumentParser(description='backup excluder')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    top = commands.add_parser('top', parents=[common],
+                              help='print the largest items to backup')
+    top.add_argument('-n', '--count', type=int, default=100)
+    top.add_argument('-d', '--directories', action='store_true',
+                     help='print directories instead of files')
+    top.add_argument('--full', action='store_true',
+                     help='sort by full size, ignoring the filters')
+    top.set_defaults(func=_printLargest)
+    export = commands.add_parser('export', parents=[common],
+                                 help='print a minimal exclude list')
+    export.add_argument('-t', '--format', default='rsync',
+                        choices=['rsync', 'tar', 'borg'])
+    export.add_argument('-g', '--min-glob', type=int, default=3,
+                        help='minimum number of excluded items folded '
+                             'in a pattern')
+    export.add_argument('-o', '--output', help='output file')
+    export.set_defaults(func=_printExcludeList)
+    scan = commands.add_parser('scan',
+                               help='write a compact binary scan of the '
+                                    'file system')
+    scan.add_argument('start', nargs='?', default='.')
+    scan.add_argument('-o', '--output',
+                      help='output file (default: standard output)')
+    scan.add_argument('-s', '--sort', action='store_true',
+                      help='sort the entries by name, to compare the '
+                           'scan with the diff command')
+    scan.add_argument('-u', '--disk-usage', action='store_true',
+                      help='also write the space allocated on disk, '
+                           'counting hard links once')
+    scan.add_argument('-c', '--concurrency', type=int, default=0,
+                      help='read up to this many directories and files '
+                           'at the same time (for network file systems, '
+                           '0 to scan serially)')
+    scan.add_argument('--timeout', type=float,
+                      help='seconds before retrying a directory '
+                           '(with --concurrency)')
+    scan.add_argument('--retries', type=int, default=2,
+                      help='times a directory is read again after a '
+                           'timeout or a transient error '
+                           '(with --concurrency)')
+    scan.set_defaults(func=_scan)
+    estimate = commands.add_parser('estimate',
+                                   help='quickly estimate the sizes by '
+                                        'sampling the file system')
+    estimate.add_argument('start', nargs='?', default='.')
+    estimate.add_argument('-f', '--filters',
+                          help='file with the filters, one regex per line '
+                               '(- for the standard input)')
+    estimate.add_argument('--match-root', action='store_true',
+                          help='match the filters against the absolute '
+                               'paths')
+    estimate.add_argument('--updates', type=float,
+                          help='print the raw estimates every this many '
+                               'seconds, until stopped')
+    estimate.add_argument('-t', '--time', type=float, default=5.0,
+                          help='seconds spent sampling')
+    estimate.add_argument('-p', '--probes', type=int,
+                          help='stop after this many probes')
+    estimate.add_argument('--seed', type=int,
+                          help='seed of the random probes')
+    estimate.set_defaults(func=_printEstimate)
+    diff = commands.add_parser('diff',
+                               help='print what changed between two '
+                                    'sorted scans')
+    diff.add_argument('old')
+    diff.add_argument('new')
+    diff.add_argument('-f', '--filters',
+                      help='file with the filters, one regex per line')
+    diff.add_argument('-m', '--min-change', type=int, default=1,
+                      help='minimum change (in bytes) to print')
+    diff.set_defaults(func=_printSnapshotDiff)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import os
+import math
+import random
+import time
+
+from model import matchNothing
+from scripts.dirsize import humanize_bytes
+
+
+__all__ = ['SizeEstimator', 'formatEstimate', 'formatRawEstimate',
+           'parseRawEstimate']
+
+
+class _RunningMean(object):
+
+    def __init__(self):
+        self.count = 0
+        self._mean = 0.0
+        self._squares = 0.0
+
+    def add(self, value):
+        # Welford's algorithm, stable also for huge sizes
+        self.count += 1
+        delta = value - self._mean
+        self._mean += delta / self.count
+        self._squares += delta * (value - self._mean)
+
+    def estimate(self, z):
+        """ Return the mean and the half width of its confidence
+        interval (None with less than 2 values).
+        """
+        if self.count < 2:
+            return (self._mean, None)
+        variance = self._squares / (self.count - 1)
+        return (self._mean, z * math.sqrt(variance / self.count))
+
+
+class SizeEstimator(object):
+
+    """ z value of the 95% confidence intervals """
+    z = 1.96
+    maxCachedDirectories = 100000
+
+    def __init__(self, rootFolder=".", cutPath=None, seed=None):
+        """ Estimate the size of the file system rooted in rootFolder,
+        and the size not pruned by cutPath, without scanning it all.
+
+        Every probe is a random walk from the root to a leaf directory,
+        choosing uniformly among the subdirectories at each level. The
+        sizes of the files met are weighted by the product of the
+        number of subdirectories along the walk (Knuth's estimator), so
+        that every probe is an unbiased estimate of the sizes. The
+        more probes, the narrower the confidence intervals.
+        """
+        super().__init__()
+        self.rootPath = os.path.abspath(rootFolder)
+        if cutPath is None:
+            cutPath = matchNothing
+        self._cutPath = cutPath
+        self._random = random.Random(seed)
+        # path -> (subdirectories, size of files, size of files not
+        # pruned) of the directories already listed
+        self._cache = {}
+        self._total = _RunningMean()
+        self._backup = _RunningMean()
+
+    @property
+    def probes(self):
+        return self._total.count
+
+    def _list(self, path):
+        listing = self._cache.get(path)
+        if listing is not None:
+            return listing
+        directories = []
+        filesSize = 0
+        includedSize = 0
+        try:
+            for entry in os.scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    size = entry.stat().st_size
+                    filesSize += size
+                    if not self._cutPath(entry.path):
+                        includedSize += size
+        except OSError:
+            # like the scan, count what has been read
+            pass
+        listing = (directories, filesSize, includedSize)
+        if len(self._cache) < self.maxCachedDirectories:
+            self._cache[path] = listing
+        return listing
+
+    def probe(self):
+        """ Walk randomly from the root to a leaf directory and add the
+        estimate of the sizes it gives.
+        """
+        path = self.rootPath
+        excluded = bool(self._cutPath(path))
+        weight = 1
+        total = 0
+        backup = 0
+        while True:
+            directories, filesSize, includedSize = self._list(path)
+            total += weight * filesSize
+            if not excluded:
+                backup += weight * includedSize
+            if not directories:
+                break
+            weight *= len(directories)
+            path = self._random.choice(directories)
+            excluded = excluded or bool(self._cutPath(path))
+        self._total.add(total)
+        self._backup.add(backup)
+
+    def refine(self, seconds=None, probes=None):
+        """ Probe until seconds have passed or probes have been done
+        (at least one probe is done).
+        """
+        deadline = None if seconds is None else time.monotonic() + seconds
+        done = 0
+        while True:
+            self.probe()
+            done += 1
+            if probes is not None and done >= probes:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if probes is None and deadline is None:
+                break
+
+    def estimate(self):
+        """ Return the estimates of the total size and of the size not
+        pruned, each as a (mean, half width of the 95% confidence
+        interval) tuple.
+        """
+        return (self._total.estimate(self.z), self._backup.estimate(self.z))
+
+
+def formatEstimate(estimate):
+    """ Format a (mean, half width) estimate of a size. """
+    mean, halfWidth = estimate
+    if halfWidth is None:
+        return humanize_bytes(round(mean))
+    return "{} \u00b1 {}".format(humanize_bytes(round(mean)),
+                                 humanize_bytes(round(halfWidth)))
+
+
+def formatRawEstimate(estimates, probes):
+    """ Format the (total, backup) estimates returned by
+    SizeEstimator.estimate and the number of probes as a line of tab
+    separated numbers, read back by parseRawEstimate.
+    """
+    fields = []
+    for mean, halfWidth in estimates:
+        fields.append(repr(mean))
+        fields.append("-" if halfWidth is None else repr(halfWidth))
+    fields.append(str(probes))
+    return "\t".join(fields)
+
+
+def parseRawEstimate(line):
+    """ Return the (total, backup) estimates and the number of probes
+    formatted by formatRawEstimate. Raise ValueError if line is not
+    such a line.
+    """
+    fields = line.split("\t")
+    if len(fields) != 5:
+        raise ValueError("not an estimate: {!r}".format(line))
+    numbers = [None if field == "-" else float(field)
+               for field in fields[:4]]
+    return (((numbers[0], numbers[1]), (numbers[2], numbers[3])),
+            int(fields[4]))
@@ -0,0 +1,189 @@
+import os
+import re
+from collections import namedtuple, Counter
+
+from model import SystemTreeNode, SystemTreeBucketNode
+
+
+__all__ = ['coveringSet', 'formatRsync', 'formatTar', 'formatBorg', 'FORMATS']
+
+""" A single path, relative to the root of the tree """
+PATH = "path"
+""" The files in path whose name match glob ("*.ext") """
+EXTENSION = "extension"
+""" The items named glob, anywhere in the tree """
+ANYWHERE = "anywhere"
+
+# paths is the list of the relative paths of the excluded items
+# covered by the entry
+ExcludeEntry = namedtuple("ExcludeEntry", "kind path glob paths")
+
+
+def _cover(node, relPath, entries, minGlob):
+    """ Append to entries the entries excluding what is excluded in
+    the subtree rooted in node (at relPath from the root).
+
+    Return True if the whole subtree is excluded: in this case nothing
+    is appended, the entry is added by the caller.
+    """
+    if node.exclusionState == SystemTreeNode.DIRECTLY_EXCLUDED:
+        return True
+    if not node.children:
+        return False
+    excluded = []
+    included = []
+    for child in node.children.values():
+        if isinstance(child, SystemTreeBucketNode):
+            for i, name in enumerate(child.names):
+                if child.isExcluded(i):
+                    excluded.append((name, True))
+                else:
+                    included.append(name)
+        elif _cover(child, os.path.join(relPath, child.name), entries,
+                    minGlob):
+            excluded.append((child.name, not child.children))
+        else:
+            included.append(child.name)
+    if not included:
+        return True
+    byExtension = {}
+    for name, isFile in excluded:
+        extension = os.path.splitext(name)[1]
+        if isFile and extension and not re.search(r"[*?\[\\]", extension):
+            byExtension.setdefault(extension, []).append(name)
+    folded = set()
+    for extension, names in sorted(byExtension.items()):
+        if len(names) < minGlob:
+            continue
+        if any(name.endswith(extension) for name in included):
+            continue
+        entries.append(ExcludeEntry(
+            EXTENSION, relPath, "*" + extension,
+            [os.path.join(relPath, name) for name in names]))
+        folded.update(names)
+    for name, isFile in excluded:
+        if name not in folded:
+            path = os.path.join(relPath, name)
+            entries.append(ExcludeEntry(PATH, path, None, [path]))
+    return False
+
+
+def _includedNames(node, names, found):
+    """ Add to found the names in names of the items not excluded in
+    the subtree rooted in node (node excluded).
+    """
+    for child in node.children.values():
+        if isinstance(child, SystemTreeBucketNode):
+            for i, name in enumerate(child.names):
+                if name in names and not child.isExcluded(i):
+                    found.add(name)
+        elif child.exclusionState != SystemTreeNode.DIRECTLY_EXCLUDED:
+            if child.name in names:
+                found.add(child.name)
+            _includedNames(child, names, found)
+
+
+def coveringSet(root, minGlob=3):
+    """ Return a small list of ExcludeEntry excluding exactly what is
+    excluded in the tree rooted in root by the last 'update'.
+
+    A directory whose items are all excluded is excluded as a whole,
+    at least minGlob excluded files of a directory sharing an
+    extension no included item has become a "*.ext" entry, and at
+    least minGlob excluded items with the same name, when no included
+    item has that name, become a single entry for that name.
+    """
+    entries = []
+    if _cover(root, "", entries, minGlob):
+        return [ExcludeEntry(PATH, "", None, [""])]
+    counter = Counter(os.path.basename(e.path)
+                      for e in entries if e.kind == PATH)
+    names = set(name for name, count in counter.items() if count >= minGlob)
+    if not names:
+        return entries
+    found = set()
+    _includedNames(root, names, found)
+    names -= found
+    anywhere = {}
+    result = []
+    for entry in entries:
+        name = os.path.basename(entry.path)
+        if entry.kind == PATH and name in names:
+            if name not in anywhere:
+                anywhere[name] = ExcludeEntry(ANYWHERE, None, name, [])
+                result.append(anywhere[name])
+            anywhere[name].paths.append(entry.path)
+        else:
+            result.append(entry)
+    return result
+
+
+def _escapeBackslash(path):
+    return re.sub(r"([*?\[\\])", r"\\\1", path)
+
+
+def _escapeBracket(path):
+    return re.sub(r"([*?\[])", r"[\1]", path)
+
+
+def _lines(patterns):
+    return "".join(pattern + "\n" for pattern in patterns)
+
+
+def formatRsync(entries, basePath):
+    """ Format entries for rsync --exclude-from. The patterns are
+    anchored to the transfer root, that must be basePath (e.g.,
+    rsync -a basePath/ destination).
+    """
+    patterns = []
+    for entry in entries:
+        if entry.kind == PATH:
+            patterns.append("/" + (_escapeBackslash(entry.path) or "*"))
+        elif entry.kind == EXTENSION:
+            patterns.append("/" + os.path.join(
+                _escapeBackslash(entry.path), entry.glob))
+        else:
+            patterns.append(_escapeBackslash(entry.glob))
+    return _lines(patterns)
+
+
+def formatTar(entries, basePath):
+    """ Format entries for tar --exclude-from. Since '*' matches also
+    '/' in tar exclusion patterns, extensions are written as the list
+    of the excluded files.
+    """
+    patterns = []
+    for entry in entries:
+        if entry.kind == PATH:
+            patterns.append(_escapeBackslash(
+                os.path.join(basePath, entry.path)))
+        elif entry.kind == EXTENSION:
+            patterns.extend(_escapeBackslash(os.path.join(basePath, path))
+                            for path in entry.paths)
+        else:
+            patterns.append(_escapeBackslash(entry.glob))
+    return _lines(patterns)
+
+
+def formatBorg(entries, basePath):
+    """ Format entries as borg patterns (--exclude-from or
+    --patterns-from). Paths use the fast path prefix style.
+    """
+    patterns = []
+    for entry in entries:
+        if entry.kind == PATH:
+            patterns.append("pp:" + os.path.join(basePath, entry.path))
+        elif entry.kind == EXTENSION:
+            patterns.append("sh:" + os.path.join(
+                _escapeBracket(os.path.join(basePath, entry.path)),
+                entry.glob))
+        else:
+            patterns.append("sh:**/" + _escapeBracket(entry.glob))
+    return _lines(patterns)
+
+
+FORMATS = {
+    "rsync": formatRsync,
+    "tar": formatTar,
+    "borg": formatBorg
+}
@@ -1,5 +1,11 @@
 import os
+import re
+import time
 import weakref
+import heapq
+import bisect
+from array import array
+from itertools import compress, islice
 
 
 def removePrefix(text, prefix):
@@ -8,10 +14,159 @@ def removePrefix(text, prefix):
     return text
 
 
+def matchNothing(ignored):
+    return False
+
+
+def compileFilters(filters, base=""):
+    """ Return a cut function matching the paths made of base followed
+    by any of the regular expressions in filters.
+
+    Blank filters are ignored. Raise re.error if a filter is not a
+    valid regular expression.
+    """
+    filters = list(filter(str.strip, filters))
+    if len(filters) == 0:
+        return matchNothing
+    return re.compile(re.escape(base) + '(' + '|'.join(filters) + ')').match
+
+
 class BadElementException(Exception):
     pass
 
 
+class FilterAttribution(object):
+
+    def __init__(self):
+        """ Statistics about a single cut function collected by
+        SystemTreeNode.attribute.
+
+        The first match counters tell what is pruned by the cut
+        function when it is the first (in order) matching a node not
+        pruned by an ancestor, the exclusive counters what is pruned by
+        it and by no other cut function, at any depth. Sizes are in bytes, nodes are number of tree nodes.
+        """
+        self.firstMatchSize = 0
+        self.firstMatchNodes = 0
+        self.exclusiveSize = 0
+        self.exclusiveNodes = 0
+        self.tests = 0
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return "FilterAttribution({})".format(", ".join(
+            "{}={}".format(k, v) for k, v in sorted(vars(self).items())))
+
+
+class InodeLinks(object):
+
+    """ Inodes added before they are merged in a sorted run """
+    mergeThreshold = 4096
+
+    def __init__(self):
+        """ Map the inode numbers of a device to the number of their
+        links not met yet, in about 12 bytes per inode.
+
+        The inodes are kept in sorted runs of packed arrays, searched
+        by bisection, and in a small dict of the ones added since the
+        last merge. Each run is at least twice as long as the next,
+        so that every inode is merged a logarithmic number of times.
+        The inodes whose links have all been met are kept with 0
+        links: a link met again (e.g., created during the scan) is
+        not taken for the first one.
+        """
+        super().__init__()
+        self._recent = {}
+        # (inode numbers, links not met yet) sorted by inode number
+        self._runs = []
+        # inodes with links not met yet
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _find(self, ino):
+        """ Return the links array and the index of ino in its run,
+        (None, None) if it is not there.
+        """
+        for inodes, links in self._runs:
+            i = bisect.bisect_left(inodes, ino)
+            if i < len(inodes) and inodes[i] == ino:
+                return (links, i)
+        return (None, None)
+
+    def meet(self, ino, nlink):
+        """ Count a link to the inode ino having nlink links and return
+        True if it is the first one met.
+        """
+        links = self._recent.get(ino)
+        if links is not None:
+            if links:
+                self._recent[ino] = links - 1
+                if links == 1:
+                    self._count -= 1
+            return False
+        links, i = self._find(ino)
+        if links is not None:
+            if links[i]:
+                links[i] -= 1
+                if not links[i]:
+                    self._count -= 1
+            return False
+        self._recent[ino] = nlink - 1
+        self._count += 1
+        if len(self._recent) >= self.mergeThreshold:
+            self._merge()
+        return True
+
+    def _merge(self):
+        run = (array('Q', sorted(self._recent)), array('I'))
+        run[1].extend(self._recent[ino] for ino in run[0])
+        self._recent = {}
+        while self._runs and len(self._runs[-1][0]) <= 2 * len(run[0]):
+            last = self._runs.pop()
+            merged = (array('Q'), array('I'))
+            for ino, links in heapq.merge(zip(*last), zip(*run)):
+                merged[0].append(ino)
+                merged[1].append(links)
+            run = merged
+        self._runs.append(run)
+
+
+class DiskUsage(object):
+
+    def __init__(self):
+        """ Compute the space allocated on disk for the files met by a
+        scan, counting the files with many hard links only once.
+
+        Only the files with more than one link are remembered, with the
+        number of their links not met yet (see InodeLinks, per device).
+        len() is the number of files with links not met yet.
+        """
+        super().__init__()
+        # st_dev -> InodeLinks
+        self._pending = {}
+
+    def __len__(self):
+        return sum(len(inodes) for inodes in self._pending.values())
+
+    def diskSize(self, stat):
+        """ Return the disk size of the file whose os.stat_result is
+        stat: 0 if another link to it has already been met.
+        """
+        blocks = getattr(stat, "st_blocks", None)
+        # st_blocks is in 512 bytes units, whatever the block size
+        size = stat.st_size if blocks is None else blocks * 512
+        if stat.st_nlink < 2:
+            return size
+        inodes = self._pending.get(stat.st_dev)
+        if inodes is None:
+            inodes = self._pending[stat.st_dev] = InodeLinks()
+        if inodes.meet(stat.st_ino, stat.st_nlink):
+            return size
+        return 0
+
+
 class SystemTreeNode(object):
 
     """ The node and the tree roted in it have not matched any filter """
@@ -21,18 +176,32 @@ class SystemTreeNode(object):
     """ The node has matched a filter """
     DIRECTLY_EXCLUDED = 2
 
-    def __init__(self, name, size=0, parent=None, children=None):
+    # the message of the error met reading the directory, set only on
+    # the nodes which could not be (completely) read
+    scanError = None
+    # set on the nodes read from a directory, which could be empty
+    isDirectory = False
+
+    def __init__(self, name, size=0, parent=None, children=None,
+                 diskSize=None):
         """ Create a new node (a tree if a list of children is supplied).
 
         A SystemTreeNode has a name and a size and an internal state.
         The size represents the size of the whole subtree rooted in the
         node (node comprised). The internal state remembers the status
         of the node w.r.t. to the filters used to prune the tree.
+        The disk size is the space allocated on disk for the node (the
+        size if not given), like the size it is summed over subtrees.
         """
         super().__init__()
         # self.name is redoundant since it is the key inside parent.children
         self._name = name
         self._subtreeTotalSize = size
+        if diskSize is None:
+            diskSize = size
+        self._subtreeDiskSize = diskSize
+        # size of the subtree not pruned by the last 'update'
+        self._subtreeCutSize = size
         if parent is not None:
             parent = weakref.ref(parent)
         else:
@@ -54,6 +223,15 @@ class SystemTreeNode(object):
     def subtreeTotalSize(self):
         return self._subtreeTotalSize
     @property
+    def subtreeCutSize(self):
+        return self._subtreeCutSize
+    @property
+    def subtreeDiskSize(self):
+        return self._subtreeDiskSize
+    @property
+    def exclusionState(self):
+        return self._currentExclusionState
+    @property
     def parent(self):
         return self._parent()
     @property
@@ -71,10 +249,14 @@ class SystemTreeNode(object):
             raise BadElementException()
         self._children[child.name] = child
         self._subtreeTotalSize += child._subtreeTotalSize
+        self._subtreeCutSize += child._subtreeCutSize
+        self._subtreeDiskSize += child._subtreeDiskSize
         child._parent = weakref.ref(self)
         sup = self.parent
         while isinstance(sup, SystemTreeNode):
             sup._subtreeTotalSize += child._subtreeTotalSize
+            sup._subtreeCutSize += child._subtreeCutSize
+            sup._subtreeDiskSize += child._subtreeDiskSize
             sup = sup.parent
 
     def getChild(self, childName):
@@ -89,6 +271,17 @@ class SystemTreeNode(object):
             raise BadElementException()
         return child
 
+    def getFullPath(self, parentPath=""):
+        """ Return the path of self, starting from the eldermost
+        predecessor which is in parentPath.
+        """
+        names = []
+        node = self
+        while node is not None:
+            names.append(node.name)
+            node = node.parent
+        return os.path.join(parentPath, *reversed(names))
+
     def _excludedPathFound(self, path):
         """ Trigger the callback that manages when a node matches
         the cut function of 'update'.
@@ -109,6 +302,10 @@ class SystemTreeNode(object):
         No events/callback are raised.
         """
         self._currentExclusionState = exclusionState
+        if exclusionState == self.DIRECTLY_EXCLUDED:
+            self._subtreeCutSize = 0
+        else:
+            self._subtreeCutSize = self._subtreeTotalSize
         for child in self.children.values():
             child._set_exclusion_state_recursive(exclusionState)
 
@@ -144,6 +341,7 @@ class SystemTreeNode(object):
                 subtreeChanged |= isPruned
                 subtreeSize += childSize
                 subtreeNodes += childNodes
+            self._subtreeCutSize = subtreeSize
             if (subtreeChanged or
                     self._currentExclusionState == self.DIRECTLY_EXCLUDED):
                 # Little hack: Compare the original size of the node
@@ -158,6 +356,7 @@ class SystemTreeNode(object):
                     self._currentExclusionState = self.PARTIALLY_INCLUDED
                     self._visibilityChanged(self.PARTIALLY_INCLUDED, subtreeSize)
             return (subtreeChanged, subtreeSize, subtreeNodes)
+        self._subtreeCutSize = self._subtreeTotalSize
         if self._currentExclusionState != self.FULLY_INCLUDED:
             self._currentExclusionState = self.FULLY_INCLUDED
             self._visibilityChanged(self.FULLY_INCLUDED, self._subtreeTotalSize)
@@ -171,35 +370,541 @@ class SystemTreeNode(object):
         modified, totalSize, totalNodes = self._update(parentPath, cutPath)
         return (totalSize, totalNodes)
 
+    def _countIncludedNodes(self):
+        """ Return the number of nodes of the subtree rooted in self
+        not pruned by the last 'update'.
+        """
+        if self._currentExclusionState == self.DIRECTLY_EXCLUDED:
+            return 0
+        return 1 + sum(c._countIncludedNodes()
+                       for c in self.children.values())
+
+    def updateSubtree(self, parentPath, cutPath):
+        """ Update only the subtree rooted in self with the given
+        cutPath, then the size and the state of its predecessors.
+
+        parentPath is the same given to 'update' on the eldermost
+        predecessor. Use it when cutPath matches differently only some
+        paths of this subtree (e.g., a filter for the path of self has
+        been added or removed): it costs O(depth + subtree size)
+        instead of a whole 'update'. Return the change of the size (in
+        bytes and in number of tree nodes) of the whole tree not pruned.
+        """
+        sup = self.parent
+        while sup is not None:
+            if sup._currentExclusionState == self.DIRECTLY_EXCLUDED:
+                # self is pruned anyway
+                return (0, 0)
+            sup = sup.parent
+        oldSize = self._subtreeCutSize
+        oldNodes = self._countIncludedNodes()
+        fullPath = self.getFullPath(parentPath)
+        modified, newSize, newNodes = self._update(
+            os.path.dirname(fullPath), cutPath)
+        sizeChange = newSize - oldSize
+        sup = self.parent
+        while sup is not None and (modified or sizeChange):
+            sup._subtreeCutSize += sizeChange
+            if sup._subtreeCutSize == sup._subtreeTotalSize:
+                exclusionState = self.FULLY_INCLUDED
+            else:
+                exclusionState = self.PARTIALLY_INCLUDED
+            if (sizeChange or
+                    exclusionState != sup._currentExclusionState):
+                sup._currentExclusionState = exclusionState
+                sup._visibilityChanged(exclusionState, sup._subtreeCutSize)
+            sup = sup.parent
+        return (sizeChange, newNodes - oldNodes)
+
+    def _compare(self, parentPath, cutPaths, active, sizes, nodes,
+                 differences):
+        """ Accumulate in sizes and nodes the size of the subtree rooted
+        in self for every cut function (by index) in active.
+
+        The internal state of the nodes is not modified.
+        """
+        fullPath = os.path.join(parentPath, self.name)
+        excluding = tuple(i for i in active if cutPaths[i](fullPath))
+        if excluding:
+            if len(excluding) != len(active):
+                differences.append(
+                    (fullPath, self._subtreeTotalSize, excluding))
+            active = tuple(i for i in active if i not in excluding)
+        for i in active:
+            nodes[i] += 1
+        if not active:
+            return
+        if self.children:
+            for child in self.children.values():
+                child._compare(fullPath, cutPaths, active, sizes, nodes,
+                               differences)
+        else:
+            for i in active:
+                sizes[i] += self._subtreeTotalSize
+
+    def _countNodes(self):
+        """ Return the number of nodes in the subtree rooted in self. """
+        return 1 + sum(c._countNodes() for c in self.children.values())
+
     @staticmethod
-    def _createSystemTreeRecursive(rootPath):
+    def _matchingFilters(path, cutPaths, stats, covering=()):
+        """ Return the indices of the cut functions matching path, but
+        the ones in covering, updating the number of tests and the time
+        spent in stats.
+        """
+        matching = []
+        for i, cutPath in enumerate(cutPaths):
+            if i in covering:
+                continue
+            start = time.perf_counter()
+            matched = cutPath(path)
+            stats[i].elapsed += time.perf_counter() - start
+            stats[i].tests += 1
+            if matched:
+                matching.append(i)
+        return matching
+
+    @staticmethod
+    def _attributeMatch(covering, matching, size, nodes, ownSize, stats):
+        """ Account a node of nodes nodes in its subtree, of which size
+        bytes, ownSize bytes of its own, matched by the cut functions in
+        matching. covering are the ones matching its ancestors.
+
+        Return the cut functions matching the node or an ancestor.
+        """
+        if matching and not covering:
+            first = stats[matching[0]]
+            first.firstMatchSize += size
+            first.firstMatchNodes += nodes
+        covering = covering + tuple(matching)
+        if len(covering) == 1:
+            only = stats[covering[0]]
+            only.exclusiveSize += ownSize
+            only.exclusiveNodes += 1
+        return covering
+
+    def _attribute(self, parentPath, cutPaths, stats, covering=()):
+        fullPath = os.path.join(parentPath, self.name)
+        matching = self._matchingFilters(fullPath, cutPaths, stats, covering)
+        ownSize = self._subtreeTotalSize - sum(
+            child._subtreeTotalSize for child in self.children.values())
+        covering = self._attributeMatch(
+            covering, matching, self._subtreeTotalSize,
+            self._countNodes() if matching else 0, ownSize, stats)
+        if len(covering) > 1:
+            # nothing below is pruned by a single cut function
+            return
+        for child in self.children.values():
+            child._attribute(fullPath, cutPaths, stats, covering)
+
+    def attribute(self, parentPath, cutPaths):
+        """ Tell how much every cut function contributes to prune the
+        tree rooted in self, in a single traversal and without changing
+        its state.
+
+        Every node is tested against the cut functions not matching its
+        ancestors, down to the nodes matched by two of them: the bytes
+        matched by a cut function are exclusive only if no other cut
+        function matches them, or an ancestor of them, too.
+        Return a list with a FilterAttribution for each cut function.
+        """
+        stats = [FilterAttribution() for cutPath in cutPaths]
+        self._attribute(parentPath, cutPaths, stats)
+        return stats
+
+    def compare(self, parentPath, cutPaths):
+        """ Evaluate several cut functions in a single traversal of the
+        tree rooted in self, without changing its state.
+
+        Return 3 values:
+        (1) the list of the sizes (in bytes) of the subtree not pruned
+        by each cut function
+        (2) the list of the sizes (in number of tree nodes) of the same
+        subtrees
+        (3) the list of the subtrees on which the cut functions disagree
+        as (path, size in bytes, indices of the cut functions pruning
+        it) tuples. Only the topmost node of each subtree is reported.
+        """
+        sizes = [0] * len(cutPaths)
+        nodes = [0] * len(cutPaths)
+        differences = []
+        self._compare(parentPath, cutPaths, tuple(range(len(cutPaths))),
+                      sizes, nodes, differences)
+        return (sizes, nodes, differences)
+
+    @staticmethod
+    def _addFiles(node, files, bucketThreshold):
+        """ Add the (name, size, disk size) tuples in files as children
+        of node. The disk sizes are None if they are not known.
+
+        If there are more than bucketThreshold files, they are stored
+        in a single SystemTreeBucketNode instead of one node each.
+        """
+        if bucketThreshold is not None and len(files) > bucketThreshold:
+            names, sizes, diskSizes = zip(*files)
+            if diskSizes[0] is None:
+                diskSizes = None
+            node.addChild(SystemTreeBucketNode(names, sizes,
+                                               diskSizes=diskSizes))
+        else:
+            for name, size, diskSize in files:
+                node.addChild(SystemTreeNode(name, size, diskSize=diskSize))
+
+    @staticmethod
+    def _createSystemTreeRecursive(rootPath, bucketThreshold=None,
+                                   diskUsage=None):
         """Recursivly create a SystemTreeNode tree depicting
         the file system footed in rootPath. Use os.scandir.
+
+        If bucketThreshold is not None, the files of a directory
+        containing more than bucketThreshold files are aggregated in
+        a single SystemTreeBucketNode. If diskUsage (a DiskUsage) is
+        not None, it gives the disk sizes of the files.
         """
         # rootPath must be an absolute path
         currentRoot = SystemTreeNode(os.path.basename(rootPath))
+        currentRoot.isDirectory = True
         nodesInSubtree = 0
+        files = []
         try:
             for entry in os.scandir(rootPath):
                 if entry.is_dir(follow_symlinks=False):
-                    path, count = SystemTreeNode._createSystemTreeRecursive(entry.path)
+                    path, count = SystemTreeNode._createSystemTreeRecursive(
+                        entry.path, bucketThreshold, diskUsage)
                     currentRoot.addChild(path)
                     nodesInSubtree += (count + 1)
                 elif entry.is_file(follow_symlinks=False):
-                    child = SystemTreeNode(entry.name, entry.stat().st_size)
-                    currentRoot.addChild(child)
+                    stat = entry.stat(follow_symlinks=False)
+                    diskSize = None
+                    if diskUsage is not None:
+                        diskSize = diskUsage.diskSize(stat)
+                    if bucketThreshold is None:
+                        child = SystemTreeNode(entry.name, stat.st_size,
+                                               diskSize=diskSize)
+                        currentRoot.addChild(child)
+                    else:
+                        files.append((entry.name, stat.st_size, diskSize))
                     nodesInSubtree += 1
         except OSError as err:
             print("WARNING: {} in {}".format(err, rootPath))
             currentRoot._name = "[DENIED]" + currentRoot._name
+        if files:
+            SystemTreeNode._addFiles(currentRoot, files, bucketThreshold)
         return (currentRoot, nodesInSubtree)
 
     @staticmethod
-    def createSystemTree(rootFolder="."):
+    def createSystemTree(rootFolder=".", bucketThreshold=None,
+                         diskUsage=False):
         """Returns a representation of the file system rooted in
         rootFolder as a SystemTreeNode tree and the prefix of the
         rootFolder in the file system.
+
+        If diskUsage is True the disk sizes of the nodes are the space
+        allocated on disk, counting hard linked files only once.
         """
         absPath = os.path.abspath(rootFolder)
-        root, nodesCount = SystemTreeNode._createSystemTreeRecursive(absPath)
+        root, nodesCount = SystemTreeNode._createSystemTreeRecursive(
+            absPath, bucketThreshold, DiskUsage() if diskUsage else None)
         return (absPath, root, nodesCount + 1)
+
+
+class SystemTreeBucketNode(SystemTreeNode):
+
+    nameTemplate = "[{} files]"
+
+    def __init__(self, names, sizes, parent=None, diskSizes=None):
+        """ Create a node aggregating many files of the same directory.
+
+        Instead of one SystemTreeNode per file, only the names and the
+        sizes of the files are stored (in compact arrays), together
+        with a mask telling which files have been excluded by the
+        filters. The files are evaluated as if they were children of
+        the parent of the bucket: the name of the bucket never appears
+        in the paths given to the cut function. The disk sizes are
+        stored only if given.
+        """
+        diskSize = None
+        if diskSizes is not None:
+            diskSizes = array("Q", diskSizes)
+            diskSize = sum(diskSizes)
+        super().__init__(self.nameTemplate.format(len(names)),
+                         sum(sizes), parent, diskSize=diskSize)
+        self._names = list(names)
+        self._sizes = array("Q", sizes)
+        self._diskSizes = diskSizes
+        self._excluded = bytearray(len(self._names))
+
+    @property
+    def names(self):
+        return self._names
+    @property
+    def sizes(self):
+        return self._sizes
+    @property
+    def diskSizes(self):
+        if self._diskSizes is None:
+            return self._sizes
+        return self._diskSizes
+
+    def __len__(self):
+        return len(self._names)
+
+    def isExcluded(self, index):
+        return bool(self._excluded[index])
+
+    def _set_exclusion_state_recursive(self, exclusionState):
+        self._currentExclusionState = exclusionState
+        value = int(exclusionState == self.DIRECTLY_EXCLUDED)
+        self._excluded = bytearray([value]) * len(self._names)
+        self._subtreeCutSize = 0 if value else self._subtreeTotalSize
+
+    def _update(self, parentPath, cutPath):
+        """ Update the mask of the excluded files with the given cutPath.
+
+        Same return values of SystemTreeNode._update, where the size
+        in number of nodes is the number of files not excluded.
+        """
+        prefix = os.path.join(parentPath, "")
+        paths = [prefix + name for name in self._names]
+        excluded = bytearray(map(bool, map(cutPath, paths)))
+        excludedCount = excluded.count(1)
+        if excludedCount:
+            for path in compress(paths, excluded):
+                self._excludedPathFound(path)
+        subtreeSize = (self._subtreeTotalSize -
+                       sum(compress(self._sizes, excluded)))
+        if excludedCount == 0:
+            exclusionState = self.FULLY_INCLUDED
+        elif excludedCount == len(excluded):
+            exclusionState = self.DIRECTLY_EXCLUDED
+        else:
+            exclusionState = self.PARTIALLY_INCLUDED
+        changed = excluded != self._excluded
+        self._excluded = excluded
+        self._subtreeCutSize = subtreeSize
+        if changed or exclusionState != self._currentExclusionState:
+            self._currentExclusionState = exclusionState
+            self._visibilityChanged(exclusionState, subtreeSize)
+        return (changed, subtreeSize, len(excluded) - excludedCount)
+
+    def _compare(self, parentPath, cutPaths, active, sizes, nodes,
+                 differences):
+        prefix = os.path.join(parentPath, "")
+        for name, size in zip(self._names, self._sizes):
+            path = prefix + name
+            excluding = tuple(i for i in active if cutPaths[i](path))
+            if excluding and len(excluding) != len(active):
+                differences.append((path, size, excluding))
+            for i in active:
+                if i not in excluding:
+                    sizes[i] += size
+                    nodes[i] += 1
+
+    def _countNodes(self):
+        return len(self._names)
+
+    def _countIncludedNodes(self):
+        return self._excluded.count(0)
+
+    def _attribute(self, parentPath, cutPaths, stats, covering=()):
+        prefix = os.path.join(parentPath, "")
+        for name, size in zip(self._names, self._sizes):
+            matching = self._matchingFilters(prefix + name, cutPaths, stats,
+                                             covering)
+            self._attributeMatch(covering, matching, size, 1, size, stats)
+
+    def expand(self):
+        """ Replace the bucket with one SystemTreeNode per file.
+
+        The new nodes keep the exclusion state of the corresponding
+        files and are returned as a list. The size of the parent does
+        not change.
+        """
+        parent = self.parent
+        if parent is None:
+            raise BadElementException()
+        del parent._children[self.name]
+        children = []
+        for i in range(len(self._names)):
+            child = self.memberNode(i)
+            child.excludedPathFoundHandler = self.excludedPathFoundHandler
+            parent._children[child.name] = child
+            children.append(child)
+        return children
+
+    def memberNode(self, index):
+        """ Return a SystemTreeNode for the index-th file, with its
+        exclusion state. Its parent is the parent of the bucket, but
+        it is not added to its children.
+        """
+        node = SystemTreeNode(self._names[index], self._sizes[index],
+                              self.parent, diskSize=self.diskSizes[index])
+        if self._excluded[index]:
+            node._currentExclusionState = self.DIRECTLY_EXCLUDED
+            node._subtreeCutSize = 0
+        return node
+
+
+class SizeIndex(object):
+
+    def __init__(self, root):
+        """ Index the files and the directories of the tree rooted in
+        root by size, to find the largest ones without walking the tree.
+
+        The index is sorted by full size. Since the cut size of a node
+        is never bigger than its full size, the largest items by cut
+        size are found scanning the index only until the full size of
+        the next item is smaller than the cut sizes already found.
+        The files in buckets are indexed one by one, with the indices
+        of the files of each bucket sorted by size.
+        """
+        super().__init__()
+        self._files = []
+        self._directories = []
+        # (bucket, indices of its files sorted by decreasing size)
+        self._buckets = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, SystemTreeBucketNode):
+                order = sorted(range(len(node)), key=node.sizes.__getitem__,
+                               reverse=True)
+                self._buckets.append((node, array("L", order)))
+            elif node.children or node.isDirectory:
+                self._directories.append(node)
+                stack.extend(node.children.values())
+            else:
+                self._files.append(node)
+        bySize = lambda node: node._subtreeTotalSize
+        self._files.sort(key=bySize, reverse=True)
+        self._directories.sort(key=bySize, reverse=True)
+
+    def _entries(self, directories):
+        """ Yield the (full size, node, member) entries of the index
+        sorted by decreasing full size, where member is the index of
+        the file in the bucket node, or -1.
+        """
+        nodes = self._directories if directories else self._files
+        entries = [((node._subtreeTotalSize, node, -1) for node in nodes)]
+        if not directories:
+            for bucket, order in self._buckets:
+                entries.append(((bucket.sizes[i], bucket, i)
+                                for i in order))
+        return heapq.merge(*entries, key=lambda entry: entry[0],
+                           reverse=True)
+
+    def largest(self, count, directories=False, cut=True):
+        """ Return the count largest files (or directories) as a list
+        of SystemTreeNode, made with memberNode for the files in
+        buckets. If cut is True they are sorted by the size computed by
+        the last 'update' and the excluded items are skipped, otherwise
+        they are sorted by full size.
+        """
+        if count <= 0:
+            return []
+        entries = self._entries(directories)
+        if not cut:
+            return [node if member < 0 else node.memberNode(member)
+                    for size, node, member in islice(entries, count)]
+        heap = []
+        for i, (size, node, member) in enumerate(entries):
+            if len(heap) == count and size <= heap[0][0]:
+                break
+            if member < 0:
+                if node._currentExclusionState == node.DIRECTLY_EXCLUDED:
+                    continue
+                size = node._subtreeCutSize
+            elif node.isExcluded(member):
+                continue
+            # -i keeps the order of the index between equal sizes
+            item = (size, -i, node, member)
+            if len(heap) < count:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+        return [node if member < 0 else node.memberNode(member)
+                for size, i, node, member in sorted(heap, reverse=True)]
+
+
+class NameIndex(object):
+
+    """ Shortest query looked up, the length of the indexed grams """
+    minQueryLength = 3
+
+    def __init__(self, root):
+        """ Index the names of the nodes of the tree rooted in root (and
+        of the files in its buckets), to find them without walking the
+        tree.
+
+        Every (lower case) name is indexed by its trigrams: a query
+        only checks the names containing its rarest trigram. An entry
+        of the index is a (node, member) tuple, where member is the
+        index of the file in the bucket node, or -1.
+        """
+        super().__init__()
+        self._nodes = []
+        self._members = array("l")
+        self._names = []
+        self._trigrams = {}
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, SystemTreeBucketNode):
+                for i, name in enumerate(node.names):
+                    self._add(node, i, name)
+                continue
+            self._add(node, -1, node.name)
+            stack.extend(node.children.values())
+
+    def __len__(self):
+        return len(self._names)
+
+    def _add(self, node, member, name):
+        entry = len(self._names)
+        name = name.lower()
+        self._nodes.append(node)
+        self._members.append(member)
+        self._names.append(name)
+        for trigram in set(name[i:i + 3] for i in range(len(name) - 2)):
+            postings = self._trigrams.get(trigram)
+            if postings is None:
+                postings = self._trigrams[trigram] = array("L")
+            postings.append(entry)
+
+    def search(self, query, limit=100):
+        """ Return at most limit entries whose name contains query
+        (ignoring case), as (node, member) tuples.
+
+        Queries shorter than minQueryLength are not looked up (an empty
+        list is returned): they would need a scan of all the names.
+        """
+        query = query.lower()
+        if len(query) < self.minQueryLength or limit <= 0:
+            return []
+        candidates = None
+        for i in range(len(query) - 2):
+            postings = self._trigrams.get(query[i:i + 3])
+            if postings is None:
+                return []
+            if candidates is None or len(postings) < len(candidates):
+                candidates = postings
+        result = []
+        for entry in candidates:
+            if query in self._names[entry]:
+                result.append((self._nodes[entry], self._members[entry]))
+                if len(result) == limit:
+                    break
+        return result
+
+    @staticmethod
+    def describe(node, member, parentPath=""):
+        """ Return the path, the cut size and the full size of the
+        entry (node, member).
+        """
+        if member < 0:
+            return (node.getFullPath(parentPath), node.subtreeCutSize,
+                    node.subtreeTotalSize)
+        path = os.path.join(os.path.dirname(node.getFullPath(parentPath)),
+                            node.names[member])
+        size = node.sizes[member]
+        return (path, 0 if node.isExcluded(member) else size, size)
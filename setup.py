@@ -37,17 +37,21 @@ backup program.""",
 
     keywords="backup",
 
-    py_modules=["backup_excluder", "model", "scripts.dirsize"],
+    py_modules=["backup_excluder", "model", "arraymodel", "excludelist",
+                "treestream", "estimator", "asyncscan", "commandline",
+                "scripts.dirsize"],
 
     #install_requires=[],
 
     extras_require={
-       "qt": ["PyQt5"]
+       "qt": ["PyQt5"],
+       "numpy": ["numpy"]
     },
 
     entry_points={
         "console_scripts": [
-            "bex = backup_excluder:main"
+            "bex = backup_excluder:main",
+            "bex-cli = commandline:main"
         ]
     }
 
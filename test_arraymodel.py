@@ -0,0 +1,126 @@
+#!/usr/shared/python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import re
+import os
+from model import SystemTreeNode, SystemTreeBucketNode
+
+try:
+    import numpy
+    from arraymodel import SystemTreeArray
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, "numpy is not installed")
+class TestSystemTreeArray(unittest.TestCase):
+
+    def setUp(self):
+        self.root = SystemTreeNode("10", 0, children={
+            "6": SystemTreeNode("6", 0, children={
+                "1": SystemTreeNode("1", 1),
+                "5": SystemTreeNode("5", 0, children={
+                    "2": SystemTreeNode("2", 2),
+                    "3": SystemTreeNode("3", 3)
+                })
+            }),
+            "4": SystemTreeNode("4", 4),
+            "b": SystemTreeNode("b", 0, children={
+                "[2 files]": SystemTreeBucketNode(["x", "y"], [10, 20])
+            })})
+        self.tree = SystemTreeArray.fromSystemTree(self.root)
+
+    def _paths(self):
+        return [self.tree.path(i) for i in range(len(self.tree))]
+
+    def test_structure(self):
+        self.assertEqual(len(self.tree), 10)
+        self.assertEqual(self.tree.names[:4], ["10", "6", "4", "b"])
+        self.assertEqual(int(self.tree.subtreeTotalSizes[0]), 40)
+        self.assertIn("10/b/x", self._paths())
+
+    def test_bad_order(self):
+        with self.assertRaises(ValueError):
+            SystemTreeArray(["a", "b", "c", "d"], [-1, 0, 1, 0],
+                            [0, 0, 1, 1])
+
+    def test_update_same_as_model(self):
+        for regex in ["nomatch", "10/6/5/2", "10/6", "10/b/y", "10/(4|6/1)",
+                      "10"]:
+            cutPath = re.compile(regex).match
+            self.assertEqual(self.tree.update(cutPath),
+                             self.root.update("", cutPath))
+
+    def test_update_pruned(self):
+        tested = []
+        def cutPath(path):
+            tested.append(path)
+            return path == "10/6"
+        self.tree.update(cutPath)
+        self.assertEqual(sorted(tested), ["10", "10/4", "10/6", "10/b",
+                                          "10/b/x", "10/b/y"])
+        self.assertEqual(self.tree.excludedPaths(), ["10/6"])
+
+    def test_states(self):
+        self.tree.update(re.compile("10/6/5|10/6/5/2").match)
+        states = dict(zip(self._paths(), self.tree.states))
+        self.assertEqual(states["10"], SystemTreeNode.PARTIALLY_INCLUDED)
+        self.assertEqual(states["10/6"], SystemTreeNode.PARTIALLY_INCLUDED)
+        self.assertEqual(states["10/6/5"], SystemTreeNode.DIRECTLY_EXCLUDED)
+        self.assertEqual(states["10/6/5/2"], SystemTreeNode.DIRECTLY_EXCLUDED)
+        self.assertEqual(states["10/4"], SystemTreeNode.FULLY_INCLUDED)
+        cutSizes = dict(zip(self._paths(), self.tree.cutSizes))
+        self.assertEqual(cutSizes["10/6"], 1)
+        self.assertEqual(self.tree.excludedPaths(), ["10/6/5"])
+
+    def _states(self, node, path=""):
+        path = os.path.join(path, node.name)
+        states = {path: (node.exclusionState, node.subtreeCutSize)}
+        if isinstance(node, SystemTreeBucketNode):
+            states[path + "*"] = bytes(node._excluded)
+        for child in node.children.values():
+            states.update(self._states(child, path))
+        return states
+
+    def test_syncSystemTree_same_as_model(self):
+        other = SystemTreeNode("10", 0, children={
+            "6": SystemTreeNode("6", 0, children={
+                "1": SystemTreeNode("1", 1),
+                "5": SystemTreeNode("5", 0, children={
+                    "2": SystemTreeNode("2", 2),
+                    "3": SystemTreeNode("3", 3)
+                })
+            }),
+            "4": SystemTreeNode("4", 4),
+            "b": SystemTreeNode("b", 0, children={
+                "[2 files]": SystemTreeBucketNode(["x", "y"], [10, 20])
+            })})
+        changes = []
+        other.getChild("6").visibilityChangedHandler = \
+            lambda state, size: changes.append((state, size))
+        found = []
+        other.getChild("6").getChild("5").excludedPathFoundHandler = \
+            found.append
+        for regex in ["10/6/5", "10/b/y", "10/6|10/b", "nomatch"]:
+            cutPath = re.compile(regex).match
+            self.tree.update(cutPath)
+            self.tree.syncSystemTree()
+            other.update("", cutPath)
+            self.assertEqual(self._states(self.root), self._states(other))
+        # rebuilt from an updated tree, only the changes are synced
+        other.update("", re.compile("10/4").match)
+        tree = SystemTreeArray.fromSystemTree(other)
+        changes.clear()
+        found.clear()
+        tree.update(re.compile("10/4|10/6/5").match)
+        tree.syncSystemTree()
+        self.assertEqual(changes, [(SystemTreeNode.PARTIALLY_INCLUDED, 1)])
+        self.assertEqual(found, ["10/6/5"])
+        self.tree.update(re.compile("10/4|10/6/5").match)
+        self.tree.syncSystemTree()
+        self.assertEqual(self._states(self.root), self._states(other))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/shared/python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import io
+import os
+import time
+import errno
+import tempfile
+from model import SystemTreeNode
+from asyncscan import AsyncScanner
+from treestream import (
+    TreeStreamReader, scanToStream, readSystemTree, writeSystemTree,
+    DIRECTORY)
+from test_treestream import _asDict
+
+
+class FlakyScanner(AsyncScanner):
+
+    retryDelay = 0
+
+    def __init__(self, failures, *args, **kwargs):
+        """ failures maps a directory to the list of the errors raised
+        by its next listings (a float: sleep for that many seconds).
+        """
+        super().__init__(*args, **kwargs)
+        self.failures = failures
+        self.calls = 0
+
+    async def _call(self, function, argument):
+        def flaky(argument):
+            if not isinstance(argument, str):
+                # the sizes of a chunk of files
+                return function(argument)
+            self.calls += 1
+            failures = self.failures.get(argument)
+            if failures:
+                failure = failures.pop(0)
+                if isinstance(failure, float):
+                    time.sleep(failure)
+                else:
+                    raise failure
+            return function(argument)
+        return await super()._call(flaky, argument)
+
+
+class TestAsyncScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.tmp.name, "root")
+        os.makedirs(os.path.join(self.base, "sub", "deep"))
+        os.makedirs(os.path.join(self.base, "many"))
+        files = [("a", 3), ("sub/b", 300), ("sub/deep/c", 1),
+                 ("sub/deep/d", 7)]
+        files.extend(("many/{}".format(i), i) for i in range(600))
+        for path, size in files:
+            with open(os.path.join(self.base, path), "w") as f:
+                f.write("x" * size)
+        os.symlink("a", os.path.join(self.base, "link"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scan_same_as_createSystemTree(self):
+        for threshold in [None, 100]:
+            expected = SystemTreeNode.createSystemTree(self.base, threshold)
+            scanner = AsyncScanner(4, bucketThreshold=threshold)
+            path, root, count, errors = scanner.scan(self.base)
+            self.assertEqual((path, count), (expected[0], expected[2]))
+            self.assertEqual(root.name, "root")
+            self.assertEqual(root.subtreeTotalSize,
+                             expected[1].subtreeTotalSize)
+            self.assertEqual(_asDict(root), _asDict(expected[1]))
+            self.assertEqual(errors, [])
+
+    def test_scan_disk_usage(self):
+        os.link(os.path.join(self.base, "a"),
+                os.path.join(self.base, "sub", "a"))
+        expected = SystemTreeNode.createSystemTree(self.base, diskUsage=True)
+        path, root, count, errors = AsyncScanner(4, diskUsage=True).scan(
+            self.base)
+        self.assertEqual(root.subtreeDiskSize, expected[1].subtreeDiskSize)
+
+    def test_scan_transient_errors(self):
+        sub = os.path.join(self.base, "sub")
+        scanner = FlakyScanner({sub: [OSError(errno.EIO, "I/O error")] * 2},
+                               retries=2)
+        path, root, count, errors = scanner.scan(self.base)
+        self.assertEqual(errors, [])
+        self.assertEqual(root.getChild("sub").subtreeTotalSize, 308)
+
+    def test_scan_permanent_error(self):
+        sub = os.path.join(self.base, "sub")
+        error = PermissionError(errno.EACCES, "Permission denied")
+        scanner = FlakyScanner({sub: [error]}, retries=5)
+        path, root, count, errors = scanner.scan(self.base)
+        self.assertEqual([(e.path, e.error) for e in errors], [(sub, error)])
+        self.assertIs(errors[0].node, root.getChild("sub"))
+        self.assertEqual(root.getChild("sub").children, {})
+        self.assertEqual(root.subtreeTotalSize, 3 + sum(range(600)))
+        # not retried: root, sub and many listed once
+        self.assertEqual(scanner.calls, 3)
+
+    def test_scan_timeout(self):
+        sub = os.path.join(self.base, "sub")
+        scanner = FlakyScanner({sub: [0.5]}, timeout=0.1, retries=1)
+        path, root, count, errors = scanner.scan(self.base)
+        self.assertEqual(errors, [])
+        self.assertEqual(root.getChild("sub").subtreeTotalSize, 308)
+        scanner = FlakyScanner({sub: [0.5, 0.5]}, timeout=0.1, retries=1)
+        path, root, count, errors = scanner.scan(self.base)
+        self.assertEqual([e.path for e in errors], [sub])
+        self.assertIsInstance(errors[0].error, TimeoutError)
+        # the listings timed out are still sleeping
+        self.assertGreaterEqual(scanner.pendingCalls, 1)
+
+    def test_scanToStream_error(self):
+        sub = os.path.join(self.base, "sub")
+        error = PermissionError(errno.EACCES, "Permission denied")
+        scanner = FlakyScanner({sub: [error]})
+        out = io.BytesIO()
+        scanner.scanToStream(self.base, out, sort=True)
+        out.seek(0)
+        path, root, count = readSystemTree(out)
+        self.assertEqual(set(root.children), {"a", "sub", "many"})
+        self.assertEqual(root.getChild("sub").scanError, str(error))
+        self.assertIsNone(root.getChild("many").scanError)
+        # written back as it has been read
+        written = io.BytesIO()
+        writeSystemTree(root, path, written, sort=True)
+        self.assertEqual(written.getvalue(), out.getvalue())
+
+    def test_scanToStream_sorted(self):
+        out = io.BytesIO()
+        AsyncScanner(4).scanToStream(self.base, out, sort=True)
+        expected = io.BytesIO()
+        scanToStream(self.base, expected, sort=True)
+        self.assertEqual(out.getvalue(), expected.getvalue())
+
+    def test_scanToStream_buffered(self):
+        for i in range(20):
+            os.makedirs(os.path.join(self.base, "sub", "deep", str(i), "x"))
+        scanner = AsyncScanner(4)
+        scanner.maxBuffered = 2
+        out = io.BytesIO()
+        scanner.scanToStream(self.base, out, sort=True)
+        out.seek(0)
+        directories = [name for kind, name, size
+                       in TreeStreamReader(out).records()
+                       if kind == DIRECTORY]
+        self.assertEqual(len(directories), 4 + 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
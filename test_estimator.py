@@ -0,0 +1,86 @@
+#!/usr/shared/python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import os
+import tempfile
+from model import SystemTreeNode, compileFilters
+from estimator import SizeEstimator, formatRawEstimate, parseRawEstimate
+
+
+class TestSizeEstimator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.tmp.name, "root")
+        # a balanced tree: every probe gives the exact sizes
+        files = [("a", 10)]
+        for sub in ["x", "y"]:
+            for deep in ["p", "q", "r"]:
+                os.makedirs(os.path.join(self.base, sub, deep))
+                files.append((os.path.join(sub, deep, "f.log"), 100))
+                files.append((os.path.join(sub, deep, "g"), 1))
+            files.append((os.path.join(sub, "b"), 20))
+        for path, size in files:
+            with open(os.path.join(self.base, path), "w") as f:
+                f.write("x" * size)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, path, size):
+        with open(os.path.join(self.base, path), "w") as f:
+            f.write("x" * size)
+
+    def test_refine_balanced_tree(self):
+        estimator = SizeEstimator(self.base, seed=1)
+        estimator.refine(probes=10)
+        self.assertEqual(estimator.probes, 10)
+        (total, totalWidth), (backup, backupWidth) = estimator.estimate()
+        self.assertEqual(total, 10 + 2 * 20 + 6 * 101)
+        self.assertEqual(totalWidth, 0)
+        self.assertEqual(backup, total)
+
+    def test_estimate_with_filters(self):
+        cutPath = compileFilters([r".*\.log", "x/p"], self.base + os.sep)
+        estimator = SizeEstimator(self.base, cutPath, seed=1)
+        estimator.refine(probes=50)
+        (total, _), (backup, _) = estimator.estimate()
+        self.assertEqual(total, 10 + 2 * 20 + 6 * 101)
+        # the walks through x/p count 3 times its single byte
+        self.assertAlmostEqual(backup, 10 + 2 * 20 + 6 - 1, delta=3)
+
+    def test_estimate_unbalanced_tree(self):
+        self._write(os.path.join("x", "p", "big"), 100000)
+        absPath, root, count = SystemTreeNode.createSystemTree(self.base)
+        estimator = SizeEstimator(self.base, seed=3)
+        estimator.refine(probes=2000)
+        (total, width), _ = estimator.estimate()
+        self.assertGreater(width, 0)
+        self.assertLess(abs(total - root.subtreeTotalSize), width)
+
+    def test_estimate_first_probe(self):
+        estimator = SizeEstimator(self.base, seed=1)
+        self.assertEqual(estimator.estimate(), ((0, None), (0, None)))
+        estimator.refine()
+        self.assertEqual(estimator.probes, 1)
+        self.assertIsNone(estimator.estimate()[0][1])
+
+    def test_probe_missing_root(self):
+        estimator = SizeEstimator(os.path.join(self.base, "missing"))
+        estimator.refine(probes=3)
+        self.assertEqual(estimator.estimate(), ((0, 0), (0, 0)))
+
+    def test_parseRawEstimate_same_as_estimate(self):
+        estimator = SizeEstimator(self.base, seed=1)
+        for probes in [1, 5]:
+            estimator.refine(probes=probes)
+            line = formatRawEstimate(estimator.estimate(), estimator.probes)
+            self.assertEqual(parseRawEstimate(line),
+                             (estimator.estimate(), estimator.probes))
+        with self.assertRaises(ValueError):
+            parseRawEstimate("Total:\t1 KB")
+
+
+if __name__ == '__main__':
+    unittest.main()
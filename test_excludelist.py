@@ -0,0 +1,109 @@
+#!/usr/shared/python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import re
+from model import SystemTreeNode, SystemTreeBucketNode
+from excludelist import (
+    coveringSet, formatRsync, formatTar, formatBorg, ExcludeEntry, PATH,
+    EXTENSION, ANYWHERE)
+
+
+class TestCoveringSet(unittest.TestCase):
+
+    def setUp(self):
+        self.root = SystemTreeNode("r", 0, children={
+            "all": SystemTreeNode("all", 0, children={
+                "x": SystemTreeNode("x", 1),
+                "y": SystemTreeNode("y", 1)}),
+            "logs": SystemTreeNode("logs", 0, children={
+                "a.log": SystemTreeNode("a.log", 1),
+                "b.log": SystemTreeNode("b.log", 1),
+                "c.log": SystemTreeNode("c.log", 1),
+                "keep.txt": SystemTreeNode("keep.txt", 1)}),
+            "p1": SystemTreeNode("p1", 0, children={
+                "cache": SystemTreeNode("cache", 0, children={
+                    "z": SystemTreeNode("z", 1)}),
+                "src": SystemTreeNode("src", 1)}),
+            "p2": SystemTreeNode("p2", 0, children={
+                "cache": SystemTreeNode("cache", 1),
+                "src": SystemTreeNode("src", 1)}),
+            "p3": SystemTreeNode("p3", 0, children={
+                "cache": SystemTreeNode("cache", 1),
+                "src": SystemTreeNode("src", 1)}),
+            "keep": SystemTreeNode("keep", 1)})
+
+    def _apply(self, regex):
+        self.root.update("", re.compile(regex).match)
+        return coveringSet(self.root)
+
+    def test_nothing_excluded(self):
+        self.assertEqual(self._apply("nomatch"), [])
+
+    def test_collapse_siblings(self):
+        entries = self._apply("r/all/[xy]")
+        self.assertEqual([(e.kind, e.path) for e in entries],
+                         [(PATH, "all")])
+        self.assertEqual(coveringSet(self.root, 1), entries)
+
+    def test_whole_tree(self):
+        entries = self._apply("r/(all|logs|p1|p2|p3|keep)")
+        self.assertEqual([(e.kind, e.path) for e in entries], [(PATH, "")])
+
+    def test_extension(self):
+        entries = self._apply(r"r/logs/.*\.log")
+        self.assertEqual(entries, [(EXTENSION, "logs", "*.log", [
+            "logs/a.log", "logs/b.log", "logs/c.log"])])
+        entries = self._apply(r"r/logs/[ab]\.log")
+        self.assertEqual(sorted(e.path for e in entries),
+                         ["logs/a.log", "logs/b.log"])
+
+    def test_extension_not_folded_if_included(self):
+        self.root.getChild("logs").addChild(SystemTreeNode("d.log", 1))
+        entries = self._apply(r"r/logs/[abc]\.log")
+        self.assertEqual([e.kind for e in entries], [PATH] * 3)
+
+    def test_anywhere(self):
+        entries = self._apply("r/p./cache")
+        self.assertEqual(entries, [(ANYWHERE, None, "cache", [
+            "p1/cache", "p2/cache", "p3/cache"])])
+        self.root.getChild("all").addChild(SystemTreeNode("cache", 1))
+        entries = self._apply("r/p./cache")
+        self.assertEqual([e.kind for e in entries], [PATH] * 3)
+
+    def test_bucket(self):
+        bucket = SystemTreeBucketNode(["a.o", "b.o", "c.o", "d.c"],
+                                      [1, 1, 1, 1])
+        self.root.getChild("keep").addChild(bucket)
+        entries = self._apply(r"r/keep/.*\.o$")
+        self.assertEqual(entries, [(EXTENSION, "keep", "*.o", [
+            "keep/a.o", "keep/b.o", "keep/c.o"])])
+        entries = self._apply(r"r/keep/")
+        self.assertEqual(entries, [(PATH, "keep", None, ["keep"])])
+
+
+class TestFormats(unittest.TestCase):
+
+    entries = [
+        ExcludeEntry(PATH, "dir/a*b", None, ["dir/a*b"]),
+        ExcludeEntry(EXTENSION, "logs", "*.log",
+                     ["logs/a.log", "logs/b.log"]),
+        ExcludeEntry(ANYWHERE, None, "cache", ["p1/cache", "p2/cache"])]
+
+    def test_rsync(self):
+        self.assertEqual(formatRsync(self.entries, "/base"),
+                         "/dir/a\\*b\n/logs/*.log\ncache\n")
+
+    def test_tar(self):
+        self.assertEqual(formatTar(self.entries, "/base"),
+                         "/base/dir/a\\*b\n/base/logs/a.log\n"
+                         "/base/logs/b.log\ncache\n")
+
+    def test_borg(self):
+        self.assertEqual(formatBorg(self.entries, "/base"),
+                         "pp:/base/dir/a*b\nsh:/base/logs/*.log\n"
+                         "sh:**/cache\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
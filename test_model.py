@@ -3,7 +3,11 @@
 
 import unittest
 import re
-from model import SystemTreeNode, BadElementException
+import os
+import tempfile
+from model import (
+    SystemTreeNode, SystemTreeBucketNode, SizeIndex, NameIndex, DiskUsage,
+    InodeLinks, BadElementException, compileFilters)
 
 
 class TestSystemTreeNode(unittest.TestCase):
@@ -60,6 +64,13 @@ class TestSystemTreeNode(unittest.TestCase):
         with self.assertRaises(BadElementException):
             self.root.addChild(fakeNode)
 
+    def test_addChild_disk_size(self):
+        root = SystemTreeNode("root", 0)
+        root.addChild(SystemTreeNode("a", 1, diskSize=4096))
+        root.addChild(SystemTreeNode("x", 8, diskSize=0))
+        self.assertEqual(root.subtreeDiskSize, 4096)
+        self.assertEqual(root.subtreeTotalSize, 9)
+
     def test_update_mock_regex(self):
         # ignore cutFunction
         fullsize, nodesCount = self.root.update("", lambda x: False)
@@ -94,6 +105,363 @@ class TestSystemTreeNode(unittest.TestCase):
         self._test_perform_update_with_regex(startingNode, "10/6", "10/6/5/3",
                                              2 ,2)
 
+    def test_update_cut_size(self):
+        self.root.update("", re.compile("10/6/5/2").match)
+        n6 = self.root.getChild("6")
+        self.assertEqual(n6.subtreeCutSize, 4)
+        self.assertEqual(n6.getChild("5").subtreeCutSize, 3)
+        self.assertEqual(self.root.subtreeCutSize, 8)
+        self.root.update("", re.compile("10/6").match)
+        self.assertEqual(n6.getChild("5").subtreeCutSize, 0)
+        self.assertEqual(self.root.subtreeCutSize, 4)
+        self.root.update("", lambda x: False)
+        self.assertEqual(n6.getChild("5").subtreeCutSize, 5)
+
+    def _assertSameAsUpdate(self, node, regex):
+        before = self.root.update("", lambda x: False)
+        change = node.updateSubtree("", re.compile(regex).match)
+        after = self.root.update("", re.compile(regex).match)
+        self.assertEqual(change, (after[0] - before[0], after[1] - before[1]))
+
+    def test_updateSubtree(self):
+        n6 = self.root.getChild("6")
+        n5 = n6.getChild("5")
+        events = []
+        n6.visibilityChangedHandler = lambda *args: events.append(args)
+        change = n5.updateSubtree("", re.compile("10/6/5$").match)
+        self.assertEqual(change, (-5, -3))
+        self.assertEqual(n5._currentExclusionState,
+                         SystemTreeNode.DIRECTLY_EXCLUDED)
+        self.assertEqual(n6._currentExclusionState,
+                         SystemTreeNode.PARTIALLY_INCLUDED)
+        self.assertEqual(events, [(SystemTreeNode.PARTIALLY_INCLUDED, 1)])
+        self.assertEqual(self.root.subtreeCutSize, 5)
+        # the descendants of an excluded node are not updated
+        self.assertEqual(n5.getChild("2").updateSubtree("", lambda x: False),
+                         (0, 0))
+        change = n5.updateSubtree("", lambda x: False)
+        self.assertEqual(change, (5, 3))
+        self.assertEqual(n6._currentExclusionState,
+                         SystemTreeNode.FULLY_INCLUDED)
+        self.assertEqual(self.root.subtreeCutSize, 10)
+
+    def test_updateSubtree_same_as_update(self):
+        n5 = self.root.getChild("6").getChild("5")
+        self._assertSameAsUpdate(n5, "10/6/5/3")
+        self._assertSameAsUpdate(n5.getChild("2"), "10/6/5/2")
+        self._assertSameAsUpdate(self.root.getChild("6"), "10/6")
+        self._assertSameAsUpdate(self.root, "10")
+
+    def test_getFullPath(self):
+        n2 = self.root.getChild("6").getChild("5").getChild("2")
+        self.assertEqual(n2.getFullPath(), "10/6/5/2")
+        self.assertEqual(n2.getFullPath("/base"), "/base/10/6/5/2")
+
+    def test_compileFilters(self):
+        cutPath = compileFilters(["", "6/5", "  ", "4$"], "10/")
+        self.assertTrue(cutPath("10/6/5/2"))
+        self.assertTrue(cutPath("10/4"))
+        self.assertFalse(cutPath("10/6"))
+        self.assertFalse(compileFilters(["", " "])("10"))
+        with self.assertRaises(re.error):
+            compileFilters(["(unbalanced"])
+
+    def test_compare(self):
+        regexes = ["10/6/5/2", "10/6", "10/6/1|10/6/5", "nomatch"]
+        cutPaths = [re.compile(r).match for r in regexes]
+        sizes, nodes, differences = self.root.compare("", cutPaths)
+        for i, cutPath in enumerate(cutPaths):
+            self.assertEqual((sizes[i], nodes[i]),
+                             self.root.update("", cutPath))
+        self.assertEqual(differences, [
+            ("10/6", 6, (1,)),
+            ("10/6/1", 1, (2,)),
+            ("10/6/5", 5, (2,)),
+            ("10/6/5/2", 2, (0,))])
+
+    def test_attribute(self):
+        regexes = ["10/6/5", "10/6/5/2", "10/6", "10/4", "nomatch"]
+        stats = self.root.attribute("", [re.compile(r).match
+                                         for r in regexes])
+        self.assertEqual([(s.firstMatchSize, s.firstMatchNodes)
+                          for s in stats],
+                         [(0, 0), (0, 0), (6, 5), (4, 1), (0, 0)])
+        # 10/6/5 is pruned by 10/6 and by 10/6/5 too
+        self.assertEqual([(s.exclusiveSize, s.exclusiveNodes)
+                          for s in stats],
+                         [(0, 0), (0, 0), (1, 2), (4, 1), (0, 0)])
+        # root, 6 and 4 are tested against every filter, 1 and 5 against
+        # the ones not matching 6
+        self.assertEqual([s.tests for s in stats], [5, 5, 3, 5, 5])
+        stats = self.root.attribute("", [re.compile(r).match
+                                         for r in ["10/6/1", "10/6/[15]"]])
+        self.assertEqual([(s.firstMatchSize, s.exclusiveSize)
+                          for s in stats], [(1, 0), (5, 5)])
+
+    def test_compare_does_not_change_state(self):
+        self.root.update("", re.compile("10/4").match)
+        self.root.compare("", [re.compile("10/6").match])
+        self.assertEqual(self.root.getChild("4")._currentExclusionState,
+                         SystemTreeNode.DIRECTLY_EXCLUDED)
+        self.assertEqual(self.root.getChild("6")._currentExclusionState,
+                         SystemTreeNode.FULLY_INCLUDED)
+
+
+class TestSystemTreeBucketNode(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = SystemTreeBucketNode(["a.txt", "b.log", "c.txt"],
+                                           [1, 2, 4])
+        self.root = SystemTreeNode("root", 0, children={
+            "dir": SystemTreeNode("dir", 0, children={
+                self.bucket.name: self.bucket}),
+            "x": SystemTreeNode("x", 8)})
+
+    def test_size(self):
+        self.assertEqual(len(self.bucket), 3)
+        self.assertEqual(self.bucket.subtreeTotalSize, 7)
+        self.assertEqual(self.root.subtreeTotalSize, 15)
+
+    def test_diskSizes(self):
+        self.assertEqual(self.bucket.diskSizes, self.bucket.sizes)
+        bucket = SystemTreeBucketNode(["a", "b"], [1, 2], diskSizes=[4096, 0])
+        parent = SystemTreeNode("dir", 0, children={bucket.name: bucket})
+        self.assertEqual(bucket.subtreeDiskSize, 4096)
+        children = bucket.expand()
+        self.assertEqual([c.subtreeDiskSize for c in children], [4096, 0])
+        self.assertEqual(parent.subtreeDiskSize, 4096)
+
+    def test_update_bucket_names(self):
+        found = []
+        self.bucket.excludedPathFoundHandler = found.append
+        size, nodes = self.root.update("", re.compile(r".*\.txt$").match)
+        self.assertEqual(size, 10)
+        self.assertEqual(nodes, 4)
+        self.assertEqual(found, ["root/dir/a.txt", "root/dir/c.txt"])
+        self.assertEqual(self.bucket._currentExclusionState,
+                         SystemTreeNode.PARTIALLY_INCLUDED)
+        size, nodes = self.root.update("", re.compile("root/dir/").match)
+        self.assertEqual((size, nodes), (8, 3))
+        self.assertEqual(self.bucket._currentExclusionState,
+                         SystemTreeNode.DIRECTLY_EXCLUDED)
+        size, nodes = self.root.update("", lambda x: False)
+        self.assertEqual((size, nodes), (15, 6))
+
+    def test_compare(self):
+        cutPaths = [re.compile(r).match for r in
+                    [r".*\.txt$", "root/dir/b", "root/x"]]
+        sizes, nodes, differences = self.root.compare("", cutPaths)
+        self.assertEqual(sizes, [10, 13, 7])
+        self.assertEqual(nodes, [4, 5, 5])
+        self.assertEqual([d[0] for d in differences], [
+            "root/dir/a.txt", "root/dir/b.log", "root/dir/c.txt", "root/x"])
+
+    def test_attribute(self):
+        stats = self.root.attribute("", [re.compile(r).match for r in
+                                         [r".*\.txt$", "root/dir/[ab]"]])
+        self.assertEqual([(s.firstMatchSize, s.firstMatchNodes)
+                          for s in stats], [(5, 2), (2, 1)])
+        self.assertEqual([(s.exclusiveSize, s.exclusiveNodes)
+                          for s in stats], [(4, 1), (2, 1)])
+        self.assertEqual([s.tests for s in stats], [6, 6])
+
+    def test_updateSubtree(self):
+        change = self.bucket.updateSubtree("", re.compile("root/dir/b").match)
+        self.assertEqual(change, (-2, -1))
+        self.assertEqual(self.root.getChild("dir").subtreeCutSize, 5)
+        self.assertEqual(self.root.getChild("dir")._currentExclusionState,
+                         SystemTreeNode.PARTIALLY_INCLUDED)
+
+    def test_expand(self):
+        self.root.update("", re.compile("root/dir/b").match)
+        children = self.bucket.expand()
+        directory = self.root.getChild("dir")
+        self.assertEqual(sorted(directory.children), ["a.txt", "b.log", "c.txt"])
+        self.assertEqual([c.parent for c in children], [directory] * 3)
+        self.assertEqual(directory.getChild("b.log")._currentExclusionState,
+                         SystemTreeNode.DIRECTLY_EXCLUDED)
+        size, nodes = self.root.update("", re.compile("root/dir/b").match)
+        self.assertEqual((size, nodes), (13, 5))
+
+    def test_create_with_threshold(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for i in range(5):
+                with open(os.path.join(tmp, str(i)), "w") as f:
+                    f.write("x" * i)
+            os.mkdir(os.path.join(tmp, "sub"))
+            with open(os.path.join(tmp, "sub", "y"), "w") as f:
+                f.write("y")
+            path, root, count = SystemTreeNode.createSystemTree(tmp, 3)
+            self.assertEqual(count, 8)
+            self.assertEqual(root.subtreeTotalSize, 11)
+            buckets = [c for c in root.children.values()
+                       if isinstance(c, SystemTreeBucketNode)]
+            self.assertEqual(len(buckets), 1)
+            self.assertEqual(sorted(buckets[0].names), list("01234"))
+            self.assertIn("y", root.getChild("sub").children)
+
+
+class TestDiskUsage(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.tmp.name, "root")
+        for directory in ["a", "b"]:
+            os.makedirs(os.path.join(self.base, directory))
+        with open(os.path.join(self.base, "a", "big"), "w") as f:
+            f.write("x" * 10000)
+        os.link(os.path.join(self.base, "a", "big"),
+                os.path.join(self.base, "b", "big"))
+        with open(os.path.join(self.base, "sparse"), "w") as f:
+            f.truncate(1 << 20)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hard_links(self):
+        usage = DiskUsage()
+        first = os.stat(os.path.join(self.base, "a", "big"))
+        self.assertGreaterEqual(usage.diskSize(first), 10000)
+        self.assertEqual(len(usage), 1)
+        second = os.stat(os.path.join(self.base, "b", "big"))
+        self.assertEqual(usage.diskSize(second), 0)
+        # all the links have been met
+        self.assertEqual(len(usage), 0)
+
+    def test_create(self):
+        path, root, count = SystemTreeNode.createSystemTree(
+            self.base, diskUsage=True)
+        self.assertEqual(root.subtreeTotalSize, 20000 + (1 << 20))
+        big = os.stat(os.path.join(self.base, "a", "big")).st_blocks * 512
+        sparse = os.stat(os.path.join(self.base, "sparse")).st_blocks * 512
+        self.assertEqual(root.subtreeDiskSize, big + sparse)
+        self.assertEqual(sorted([root.getChild("a").subtreeDiskSize,
+                                 root.getChild("b").subtreeDiskSize]),
+                         [0, big])
+        path, root, count = SystemTreeNode.createSystemTree(self.base, 0)
+        self.assertEqual(root.subtreeDiskSize, root.subtreeTotalSize)
+
+    def test_meet_merged(self):
+        inodes = InodeLinks()
+        inodes.mergeThreshold = 3
+        # inode i has i % 4 + 2 links, met in a scattered order
+        order = [(i * 37) % 100 for i in range(100)]
+        order += [i for i in reversed(range(100)) for j in range(i % 4 + 1)]
+        firsts = [i for i in order if inodes.meet(i, i % 4 + 2)]
+        self.assertEqual(firsts, order[:100])
+        self.assertEqual(len(inodes), 0)
+        # a link created during the scan is not counted again
+        self.assertFalse(inodes.meet(5, 2))
+        self.assertFalse(inodes.meet(99, 3))
+        self.assertEqual(len(inodes), 0)
+        self.assertTrue(inodes.meet(100, 2))
+        self.assertEqual(len(inodes), 1)
+
+
+class TestSizeIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = SystemTreeNode("r", 0, children={
+            "a": SystemTreeNode("a", 0, children={
+                "big": SystemTreeNode("big", 100),
+                "small": SystemTreeNode("small", 1),
+            }),
+            "b": SystemTreeNode("b", 0, children={
+                "c": SystemTreeNode("c", 0, children={
+                    "mid": SystemTreeNode("mid", 50),
+                    "mid2": SystemTreeNode("mid2", 40)
+                })
+            }),
+            "tiny": SystemTreeNode("tiny", 2)})
+        self.index = SizeIndex(self.root)
+
+    def _names(self, nodes):
+        return [n.name for n in nodes]
+
+    def test_full_size(self):
+        self.assertEqual(self._names(self.index.largest(3, cut=False)),
+                         ["big", "mid", "mid2"])
+        self.assertEqual(self._names(self.index.largest(10, True, False)),
+                         ["r", "a", "b", "c"])
+
+    def test_cut_size(self):
+        self.root.update("", re.compile("r/a/big|r/b/c/mid$").match)
+        self.assertEqual(self._names(self.index.largest(2)),
+                         ["mid2", "tiny"])
+        self.assertEqual([n.subtreeCutSize
+                          for n in self.index.largest(10, True)],
+                         [43, 40, 40, 1])
+        self.root.update("", re.compile("r/b").match)
+        self.assertEqual(self._names(self.index.largest(10)),
+                         ["big", "tiny", "small"])
+        self.assertEqual(self.index.largest(0), [])
+
+    def test_buckets(self):
+        bucket = SystemTreeBucketNode(["x", "y", "z"], [30, 200, 3])
+        empty = SystemTreeNode("empty")
+        empty.isDirectory = True
+        self.root.getChild("b").addChild(SystemTreeNode("many", 0, children={
+            bucket.name: bucket}))
+        self.root.addChild(empty)
+        index = SizeIndex(self.root)
+        self.assertEqual(self._names(index.largest(3, cut=False)),
+                         ["y", "big", "mid"])
+        self.assertEqual(index.largest(1, cut=False)[0].getFullPath(),
+                         "r/b/many/y")
+        self.assertIn("empty", self._names(index.largest(10, True)))
+        self.assertNotIn("empty", self._names(index.largest(10)))
+        self.root.update("", re.compile("r/b/many/y").match)
+        largest = index.largest(3)
+        self.assertEqual(self._names(largest), ["big", "mid", "mid2"])
+        largest = index.largest(10)
+        self.assertEqual(self._names(largest)[3:5], ["x", "z"])
+        self.assertEqual(largest[3].subtreeCutSize, 30)
+
+
+class TestNameIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = SystemTreeBucketNode(["Report.PDF", "notes.txt"],
+                                           [10, 20])
+        self.root = SystemTreeNode("root", 0, children={
+            "docs": SystemTreeNode("docs", 0, children={
+                "report.txt": SystemTreeNode("report.txt", 1),
+                self.bucket.name: self.bucket}),
+            "src": SystemTreeNode("src", 0, children={
+                "reporter.py": SystemTreeNode("reporter.py", 2)})})
+        self.index = NameIndex(self.root)
+
+    def _paths(self, entries):
+        return sorted(NameIndex.describe(node, member)[0]
+                      for node, member in entries)
+
+    def test_len(self):
+        self.assertEqual(len(self.index), 7)
+
+    def test_search(self):
+        self.assertEqual(self._paths(self.index.search("REPORT")), [
+            "root/docs/Report.PDF", "root/docs/report.txt",
+            "root/src/reporter.py"])
+        self.assertEqual(self._paths(self.index.search("rt.t")),
+                         ["root/docs/report.txt"])
+        # too short to be looked up
+        self.assertEqual(self.index.search("s"), [])
+        self.assertEqual(self.index.search("rc"), [])
+        self.assertEqual(self._paths(self.index.search("src")),
+                         ["root/src"])
+        self.assertEqual(self.index.search("xyz"), [])
+        self.assertEqual(self.index.search(""), [])
+        self.assertEqual(len(self.index.search("report", 2)), 2)
+
+    def test_describe(self):
+        self.root.update("", re.compile("root/docs/notes").match)
+        node, member = self.index.search("notes")[0]
+        self.assertEqual(NameIndex.describe(node, member, "/base"),
+                         ("/base/root/docs/notes.txt", 0, 20))
+        node, member = self.index.search("docs")[0]
+        self.assertEqual(NameIndex.describe(node, member),
+                         ("root/docs", 11, 31))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,244 @@
+#!/usr/shared/python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import io
+import re
+import os
+import tempfile
+from model import SystemTreeNode, SystemTreeBucketNode
+from treestream import (
+    TreeStreamWriter, TreeStreamReader, scanToStream, writeSystemTree,
+    readSystemTree, streamEntries, treeEntries, SnapshotDiff,
+    BadStreamException, FILE, DIRECTORY, END_DIRECTORY, DENIED, DISK_SIZE,
+    END)
+
+
+def _asDict(node):
+    if isinstance(node, SystemTreeBucketNode):
+        return dict(zip(node.names, node.sizes))
+    if not node.children:
+        return node.subtreeTotalSize
+    return {name: _asDict(child) for name, child in node.children.items()}
+
+
+class TestTreeStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base = os.path.join(self.tmp.name, "root")
+        os.makedirs(os.path.join(self.base, "sub", "deep"))
+        for path, size in [("a", 3), ("sub/b", 300), ("sub/deep/c", 1),
+                           ("sub/deep/dè", 70000)]:
+            with open(os.path.join(self.base, path), "w") as f:
+                f.write("x" * size)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _scan(self):
+        out = io.BytesIO()
+        scanToStream(self.base, out)
+        out.seek(0)
+        return out
+
+    def test_scan_same_as_createSystemTree(self):
+        path, root, count = readSystemTree(self._scan())
+        expected = SystemTreeNode.createSystemTree(self.base)
+        self.assertEqual(path, expected[0])
+        self.assertEqual(count, expected[2])
+        self.assertEqual(root.subtreeTotalSize, 70304)
+        self.assertEqual(_asDict(root), _asDict(expected[1]))
+
+    def test_small_chunks(self):
+        stream = self._scan()
+        reader = TreeStreamReader(stream)
+        reader.chunkSize = 1
+        kinds = [kind for kind, name, size in reader.records()]
+        self.assertEqual(kinds.count(FILE), 4)
+        self.assertEqual(kinds.count(DIRECTORY), 3)
+        self.assertEqual(kinds.count(END_DIRECTORY), 3)
+
+    def test_bucket_threshold(self):
+        path, root, count = readSystemTree(self._scan(), 1)
+        deep = root.getChild("sub").getChild("deep")
+        self.assertEqual(len(deep.children), 1)
+        bucket = list(deep.children.values())[0]
+        self.assertIsInstance(bucket, SystemTreeBucketNode)
+        self.assertEqual(count, 7)
+
+    def test_write_sorted(self):
+        path, root, count = SystemTreeNode.createSystemTree(self.base)
+        out = io.BytesIO()
+        writeSystemTree(root, path, out, sort=True)
+        out.seek(0)
+        reader = TreeStreamReader(out)
+        names = [name for kind, name, size in reader.records() if name]
+        self.assertEqual(names, ["root", "a", "sub", "b", "deep", "c",
+                                 "dè"])
+
+    def test_denied(self):
+        out = io.BytesIO()
+        writer = TreeStreamWriter(out, "/r")
+        writer.startDirectory("r")
+        writer.startDirectory("secret")
+        writer.denied()
+        writer.endDirectory()
+        writer.endDirectory()
+        writer.close()
+        out.seek(0)
+        path, root, count = readSystemTree(out)
+        self.assertEqual(list(root.children), ["[DENIED]secret"])
+        out = io.BytesIO()
+        writeSystemTree(root, path, out)
+        out.seek(0)
+        path, root, count = readSystemTree(out)
+        self.assertEqual(list(root.children), ["[DENIED]secret"])
+
+    def test_disk_usage(self):
+        os.link(os.path.join(self.base, "a"),
+                os.path.join(self.base, "sub", "a"))
+        out = io.BytesIO()
+        scanToStream(self.base, out, diskUsage=True)
+        out.seek(0)
+        path, root, count = readSystemTree(out)
+        expected = SystemTreeNode.createSystemTree(self.base, diskUsage=True)
+        self.assertEqual(count, expected[2])
+        self.assertEqual(_asDict(root), _asDict(expected[1]))
+        self.assertEqual(root.subtreeDiskSize, expected[1].subtreeDiskSize)
+        out = io.BytesIO()
+        writeSystemTree(expected[1], path, out, sort=True, diskUsage=True)
+        out.seek(0)
+        path, root, count = readSystemTree(out, 1)
+        self.assertEqual(root.subtreeDiskSize, expected[1].subtreeDiskSize)
+        deep = root.getChild("sub").getChild("deep")
+        bucket = list(deep.children.values())[0]
+        self.assertEqual(sum(bucket.diskSizes), deep.subtreeDiskSize)
+
+    def test_bad_stream(self):
+        with self.assertRaises(BadStreamException):
+            readSystemTree(io.BytesIO(b"NOPE"))
+        truncated = self._scan().getvalue()[:-10]
+        with self.assertRaises(BadStreamException):
+            readSystemTree(io.BytesIO(truncated))
+
+    def test_records_out_of_order(self):
+        out = io.BytesIO()
+        TreeStreamWriter(out, "/r")
+        header = out.getvalue()
+        for records in [END_DIRECTORY, FILE + b"\x01a\x03", DENIED,
+                        DIRECTORY + b"\x01r" + DISK_SIZE + b"\x03",
+                        DIRECTORY + b"\x01r" + END_DIRECTORY +
+                        DIRECTORY + b"\x01s" + END_DIRECTORY]:
+            with self.assertRaises(BadStreamException):
+                readSystemTree(io.BytesIO(header + records + END))
+            reader = TreeStreamReader(io.BytesIO(header + records + END))
+            with self.assertRaises(BadStreamException):
+                list(streamEntries(reader))
+
+
+
+class TestSnapshotDiff(unittest.TestCase):
+
+    def setUp(self):
+        self.old = SystemTreeNode("old", 0, children={
+            "same": SystemTreeNode("same", 0, children={
+                "f": SystemTreeNode("f", 5)}),
+            "grow": SystemTreeNode("grow", 0, children={
+                "f": SystemTreeNode("f", 1),
+                "sub": SystemTreeNode("sub", 0, children={
+                    "g": SystemTreeNode("g", 2)})}),
+            "gone": SystemTreeNode("gone", 0, children={
+                "x": SystemTreeNode("x", 7),
+                "y": SystemTreeNode("y", 3)}),
+            "kind": SystemTreeNode("kind", 4)})
+        self.new = SystemTreeNode("new", 0, children={
+            "same": SystemTreeNode("same", 0, children={
+                "f": SystemTreeNode("f", 5)}),
+            "grow": SystemTreeNode("grow", 0, children={
+                "f": SystemTreeNode("f", 1),
+                "sub": SystemTreeNode("sub", 0, children={
+                    "g": SystemTreeNode("g", 12),
+                    "h": SystemTreeNode("h", 100)})}),
+            "kind": SystemTreeNode("kind", 0, children={
+                "k": SystemTreeNode("k", 6)}),
+            "added": SystemTreeNode("added", 0, children={
+                "z": SystemTreeNode("z", 20)})})
+
+    def _stream(self, root):
+        out = io.BytesIO()
+        writeSystemTree(root, "/base", out, sort=True)
+        out.seek(0)
+        return streamEntries(TreeStreamReader(out))
+
+    def test_entries(self):
+        self.assertEqual(list(self._stream(self.old)),
+                         list(treeEntries(self.old)))
+        paths = [path for path, isDirectory, size in treeEntries(self.new)]
+        self.assertEqual(paths, sorted(paths))
+
+    def test_changes(self):
+        diff = SnapshotDiff(self._stream(self.old), treeEntries(self.new))
+        changes = list(diff.changes())
+        self.assertEqual(changes, [
+            (SnapshotDiff.ADDED, "added", 0, 20),
+            (SnapshotDiff.REMOVED, "gone", 10, 0),
+            (SnapshotDiff.ADDED, "grow/sub/h", 0, 100),
+            (SnapshotDiff.CHANGED, "grow/sub", 2, 112),
+            (SnapshotDiff.CHANGED, "grow", 3, 113),
+            (SnapshotDiff.REMOVED, "kind", 4, 0),
+            (SnapshotDiff.ADDED, "kind", 0, 6),
+            (SnapshotDiff.CHANGED, "", 22, 144)])
+        self.assertEqual(diff.totalSizes, [22, 144])
+        self.assertEqual(diff.backupSizes, [22, 144])
+
+    def test_backup_sizes(self):
+        cutPath = re.compile("/base/(grow/sub|kind$)").match
+        diff = SnapshotDiff(treeEntries(self.old), treeEntries(self.new),
+                            cutPath, "/base")
+        list(diff.changes())
+        self.assertEqual(diff.backupSizes, [22 - 2 - 4, 144 - 112 - 6])
+
+    def test_scan_same_as_tree(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            base = os.path.join(tmp, "root")
+            os.makedirs(os.path.join(base, "sub", "empty"))
+            os.makedirs(os.path.join(base, "empty"))
+            for path, size in [("a", 3), ("sub/b", 30), ("z", 1)]:
+                with open(os.path.join(base, path), "w") as f:
+                    f.write("x" * size)
+            out = io.BytesIO()
+            scanToStream(base, out, sort=True)
+            path, root, count = SystemTreeNode.createSystemTree(base)
+        out.seek(0)
+        scanned = list(streamEntries(TreeStreamReader(out)))
+        self.assertEqual(scanned, list(treeEntries(root)))
+        self.assertIn((("empty",), False, 0), scanned)
+        diff = SnapshotDiff(iter(scanned), treeEntries(root))
+        self.assertEqual(list(diff.changes()), [])
+
+    def test_denied_sorted(self):
+        root = SystemTreeNode("r", 0, children={
+            "a": SystemTreeNode("a", 1),
+            "[DENIED]b": SystemTreeNode("[DENIED]b", 0, children={
+                "f": SystemTreeNode("f", 2)}),
+            "[DENIED]bb": SystemTreeNode("[DENIED]bb"),
+            "ba": SystemTreeNode("ba", 3)})
+        paths = [path for path, isDirectory, size in treeEntries(root)]
+        self.assertEqual(paths, [(), ("a",), ("b",), ("b", "f"), ("ba",),
+                                 ("bb",)])
+        self.assertEqual(list(self._stream(root)), list(treeEntries(root)))
+        out = io.BytesIO()
+        writeSystemTree(root, "/base", out, sort=True)
+        out.seek(0)
+        records = [(kind, name) for kind, name, size
+                   in TreeStreamReader(out).records()]
+        self.assertEqual(records, [
+            (DIRECTORY, "r"), (FILE, "a"), (DIRECTORY, "b"), (DENIED, None),
+            (FILE, "f"), (END_DIRECTORY, None), (FILE, "ba"),
+            (DIRECTORY, "bb"), (DENIED, None), (END_DIRECTORY, None),
+            (END_DIRECTORY, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,544 @@
+import os
+import sys
+
+from model import (
+    SystemTreeNode, SystemTreeBucketNode, DiskUsage, removePrefix)
+
+
+__all__ = ['TreeStreamWriter', 'TreeStreamReader', 'scanToStream',
+           'writeSystemTree', 'readSystemTree', 'streamEntries',
+           'treeEntries', 'SnapshotDiff', 'BadStreamException']
+
+MAGIC = b"BEXT"
+VERSION = 2
+
+""" The children of every directory are sorted by name """
+SORTED = 0x01
+""" Every file record is followed by the disk size of the file """
+DISK_USAGE = 0x02
+
+""" A directory starts: the following records are its content """
+DIRECTORY = b"D"
+""" The current directory ends """
+END_DIRECTORY = b"U"
+""" A file of the current directory, with its size """
+FILE = b"F"
+""" The current directory could not be (completely) read """
+DENIED = b"X"
+""" Like DENIED, with the message of the error """
+ERROR = b"R"
+""" The disk size of the previous file (in DISK_USAGE streams) """
+DISK_SIZE = b"B"
+""" The stream ends """
+END = b"E"
+
+
+DENIED_PREFIX = "[DENIED]"
+
+
+class BadStreamException(Exception):
+    pass
+
+
+def _encodeVarint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def _encodeName(name):
+    name = os.fsencode(name)
+    return _encodeVarint(len(name)) + name
+
+
+class TreeStreamWriter(object):
+
+    def __init__(self, out, rootPath, flags=0):
+        """ Write a file system tree as a compact binary stream on the
+        binary file object out.
+
+        The stream is a header with the flags (e.g., SORTED) and the
+        absolute path of the root, followed by a record for each
+        directory start, file, read error and directory end, in depth
+        first order. Sizes and lengths are variable length integers,
+        names are encoded as the file system does. Nothing is kept in
+        memory: the stream can be decoded while it is being written.
+        """
+        super().__init__()
+        self._out = out
+        self._flags = flags
+        out.write(MAGIC + bytes([VERSION, flags]) + _encodeName(rootPath))
+
+    def startDirectory(self, name):
+        self._out.write(DIRECTORY + _encodeName(name))
+
+    def endDirectory(self):
+        self._out.write(END_DIRECTORY)
+
+    def addFile(self, name, size, diskSize=None):
+        record = FILE + _encodeName(name) + _encodeVarint(size)
+        if self._flags & DISK_USAGE:
+            if diskSize is None:
+                diskSize = size
+            record += DISK_SIZE + _encodeVarint(diskSize)
+        self._out.write(record)
+
+    def denied(self):
+        self._out.write(DENIED)
+
+    def error(self, message):
+        self._out.write(ERROR + _encodeName(message))
+
+    def close(self):
+        self._out.write(END)
+        self._out.flush()
+
+
+def _scanRecursive(writer, rootPath, name, sort, diskUsage):
+    writer.startDirectory(name)
+    try:
+        entries = os.scandir(rootPath)
+        if sort:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _scanRecursive(writer, entry.path, entry.name, sort,
+                               diskUsage)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                diskSize = None
+                if diskUsage is not None:
+                    diskSize = diskUsage.diskSize(stat)
+                writer.addFile(entry.name, stat.st_size, diskSize)
+    except OSError as err:
+        print("WARNING: {} in {}".format(err, rootPath), file=sys.stderr)
+        writer.denied()
+    writer.endDirectory()
+
+
+def _flags(sort, diskUsage):
+    return (SORTED if sort else 0) | (DISK_USAGE if diskUsage else 0)
+
+
+def scanToStream(rootFolder, out, sort=False, diskUsage=False):
+    """ Scan the file system rooted in rootFolder (like
+    SystemTreeNode.createSystemTree) writing it on out as a stream.
+
+    If sort is True the entries of every directory are written sorted
+    by name: such a stream is a snapshot that can be compared with
+    another one by SnapshotDiff. If diskUsage is True the disk sizes
+    of the files are written too.
+    """
+    absPath = os.path.abspath(rootFolder)
+    writer = TreeStreamWriter(out, absPath, _flags(sort, diskUsage))
+    _scanRecursive(writer, absPath, os.path.basename(absPath), sort,
+                   DiskUsage() if diskUsage else None)
+    writer.close()
+
+
+def _children(node, sort):
+    """ Yield the children of node as (name, size, disk size, child)
+    tuples, where child is None for the files in buckets.
+    """
+    children = []
+    for child in node.children.values():
+        if isinstance(child, SystemTreeBucketNode):
+            children.extend(zip(child.names, child.sizes, child.diskSizes,
+                                [None] * len(child)))
+        else:
+            # sorted by the name written in the stream
+            children.append((removePrefix(child.name, DENIED_PREFIX),
+                             child.subtreeTotalSize, child.subtreeDiskSize,
+                             child))
+    if sort:
+        children.sort(key=lambda child: child[0])
+    return children
+
+
+def _writeRecursive(writer, node, sort):
+    name = removePrefix(node.name, DENIED_PREFIX)
+    writer.startDirectory(name)
+    if node.scanError is not None:
+        writer.error(node.scanError)
+    elif name != node.name:
+        writer.denied()
+    for name, size, diskSize, child in _children(node, sort):
+        if child is not None and (child.children or name != child.name or
+                                  child.scanError is not None):
+            _writeRecursive(writer, child, sort)
+        else:
+            writer.addFile(name, size, diskSize)
+    writer.endDirectory()
+
+
+def writeSystemTree(root, basePath, out, sort=False, diskUsage=False):
+    """ Write the SystemTreeNode tree root, whose absolute path is
+    basePath, on out as a stream. If sort is True the children of
+    every directory are written sorted by name. If diskUsage is True
+    the disk sizes of the files are written too.
+
+    Files in buckets are written one by one. Since the tree does not
+    tell apart empty directories from files, the former are written as
+    files.
+    """
+    writer = TreeStreamWriter(out, basePath, _flags(sort, diskUsage))
+    _writeRecursive(writer, root, sort)
+    writer.close()
+
+
+class TreeStreamReader(object):
+
+    chunkSize = 1 << 16
+
+    def __init__(self, inp):
+        """ Decode the stream written by a TreeStreamWriter on the
+        binary file object inp, reading it a chunk at a time.
+        """
+        super().__init__()
+        self._inp = inp
+        self._buffer = b""
+        self._position = 0
+        if self._read(len(MAGIC)) != MAGIC:
+            raise BadStreamException("not a tree stream")
+        version = self._read(1)[0]
+        if version == 1:
+            self.flags = 0
+        elif version == VERSION:
+            self.flags = self._read(1)[0]
+        else:
+            raise BadStreamException(
+                "unsupported version {}".format(version))
+        self.rootPath = self._readName()
+
+    def _fill(self, size):
+        """ Make at least size bytes available in the buffer. """
+        self._buffer = self._buffer[self._position:]
+        self._position = 0
+        while len(self._buffer) < size:
+            chunk = self._inp.read(max(self.chunkSize, size))
+            if not chunk:
+                raise BadStreamException("truncated stream")
+            self._buffer += chunk
+
+    def _read(self, size):
+        if self._position + size > len(self._buffer):
+            self._fill(size)
+        data = self._buffer[self._position:self._position + size]
+        self._position += size
+        return data
+
+    def _readVarint(self):
+        value = 0
+        shift = 0
+        while True:
+            byte = self._read(1)[0]
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def _readName(self):
+        return os.fsdecode(self._read(self._readVarint()))
+
+    def records(self):
+        """ Yield the records of the stream as (kind, name, size)
+        tuples, with name and size None when not meaningful.
+        """
+        while True:
+            kind = self._read(1)
+            if kind == FILE:
+                name = self._readName()
+                yield (kind, name, self._readVarint())
+            elif kind == DIRECTORY:
+                yield (kind, self._readName(), None)
+            elif kind == DISK_SIZE:
+                yield (kind, None, self._readVarint())
+            elif kind == ERROR:
+                yield (kind, self._readName(), None)
+            elif kind in (END_DIRECTORY, DENIED):
+                yield (kind, None, None)
+            elif kind == END:
+                return
+            else:
+                raise BadStreamException("bad record {!r}".format(kind))
+
+
+class TreeBuilder(object):
+
+    def __init__(self, bucketThreshold=None):
+        """ Build a SystemTreeNode tree from the same calls made on a
+        TreeStreamWriter (without the header and close).
+
+        Raise BadStreamException on the calls out of order.
+        """
+        super().__init__()
+        self.bucketThreshold = bucketThreshold
+        self.root = None
+        self.nodesCount = 0
+        # (directory, files not added yet) for every open directory
+        self._stack = []
+
+    def _current(self):
+        """ Return the (directory, files) of the open directory. """
+        if not self._stack:
+            raise BadStreamException("record outside of the root")
+        return self._stack[-1]
+
+    def startDirectory(self, name):
+        if self.root is not None:
+            raise BadStreamException("directory after the root")
+        self.nodesCount += 1
+        node = SystemTreeNode(name)
+        node.isDirectory = True
+        self._stack.append((node, []))
+
+    def endDirectory(self):
+        node, files = self._current()
+        self._stack.pop()
+        SystemTreeNode._addFiles(node, files, self.bucketThreshold)
+        if self._stack:
+            self._stack[-1][0].addChild(node)
+        else:
+            self.root = node
+
+    def addFile(self, name, size, diskSize=None):
+        files = self._current()[1]
+        self.nodesCount += 1
+        # the files are added when their directory ends
+        files.append((name, size, diskSize))
+
+    def setDiskSize(self, diskSize):
+        """ Set the disk size of the last file added. """
+        files = self._current()[1]
+        if not files:
+            raise BadStreamException("disk size without a file")
+        name, size, old = files[-1]
+        files[-1] = (name, size, diskSize)
+
+    def denied(self):
+        node = self._current()[0]
+        node._name = DENIED_PREFIX + node._name
+
+    def error(self, message):
+        self._current()[0].scanError = message
+
+    def isComplete(self):
+        return self.root is not None and not self._stack
+
+
+def readSystemTree(inp, bucketThreshold=None):
+    """ Build a SystemTreeNode tree from the stream on inp, while it
+    is being read.
+
+    Same return values of SystemTreeNode.createSystemTree. The
+    directories which could not be read are named with DENIED_PREFIX
+    or, if the error is known, have it in their scanError.
+    """
+    reader = TreeStreamReader(inp)
+    builder = TreeBuilder(bucketThreshold)
+    for kind, name, size in reader.records():
+        if kind == FILE:
+            builder.addFile(name, size)
+        elif kind == DISK_SIZE:
+            builder.setDiskSize(size)
+        elif kind == DIRECTORY:
+            builder.startDirectory(name)
+        elif kind == DENIED:
+            builder.denied()
+        elif kind == ERROR:
+            builder.error(name)
+        elif kind == END_DIRECTORY:
+            builder.endDirectory()
+    if not builder.isComplete():
+        raise BadStreamException("incomplete tree")
+    return (reader.rootPath, builder.root, builder.nodesCount)
+
+
+def streamEntries(reader):
+    """ Yield the entries of the stream decoded by reader as
+    (path, isDirectory, size) tuples, where path is the tuple of the
+    names from the root (excluded) and size is 0 for directories.
+
+    Like in treeEntries, empty directories are yielded as files, since
+    the tree does not tell them apart.
+    """
+    names = []
+    depth = 0
+    # the directory just started, yielded when its first entry comes
+    opened = None
+    for kind, name, size in reader.records():
+        if not depth and kind != DIRECTORY:
+            raise BadStreamException("record outside of the root")
+        if kind in (FILE, DIRECTORY) and opened is not None:
+            yield (opened, True, 0)
+            opened = None
+        if kind == FILE:
+            yield (tuple(names) + (name,), False, size)
+        elif kind == DIRECTORY:
+            if depth == 0 and names is None:
+                raise BadStreamException("directory after the root")
+            # the name of the root is not part of the paths
+            if depth:
+                names.append(name)
+            depth += 1
+            opened = tuple(names)
+        elif kind == END_DIRECTORY:
+            if opened is not None:
+                # the root is a directory even if empty
+                yield (opened, depth == 1, 0)
+                opened = None
+            depth -= 1
+            if depth:
+                names.pop()
+            else:
+                names = None
+    if depth:
+        raise BadStreamException("incomplete tree")
+
+
+def _treeEntries(node, path):
+    for name, size, diskSize, child in _children(node, True):
+        childPath = path + (name,)
+        if child is not None and child.children:
+            yield (childPath, True, 0)
+            yield from _treeEntries(child, childPath)
+        else:
+            yield (childPath, False, size)
+
+
+def treeEntries(root):
+    """ Yield the entries of the SystemTreeNode tree root like
+    streamEntries does for a sorted stream.
+    """
+    yield ((), True, 0)
+    yield from _treeEntries(root, ())
+
+
+def _isUnder(path, prefix):
+    return path[:len(prefix)] == prefix
+
+
+class SnapshotDiff(object):
+
+    """ A directory present in both the snapshots changed its size """
+    CHANGED = "changed"
+    """ A subtree is only in the new snapshot """
+    ADDED = "added"
+    """ A subtree is only in the old snapshot """
+    REMOVED = "removed"
+
+    def __init__(self, oldEntries, newEntries, cutPath=None, basePath=""):
+        """ Compare two snapshots given as iterables of entries sorted
+        by path (see streamEntries and treeEntries).
+
+        The snapshots are merged like sorted lists, keeping in memory
+        only the directories containing the current entry, so that
+        they can be compared directly from the stream files. cutPath
+        is applied (as in SystemTreeNode.update) to the paths of both
+        the snapshots made absolute with basePath, to compute their
+        backup sizes.
+        """
+        super().__init__()
+        self._entries = (iter(oldEntries), iter(newEntries))
+        self._cutPath = cutPath
+        self._basePath = basePath
+        self.totalSizes = [0, 0]
+        self.backupSizes = [0, 0]
+        # [path, old size, new size] of the open directories in both
+        # the snapshots
+        self._directories = []
+        # [path, size] of the subtree only in the old/new snapshot
+        self._only = [None, None]
+        self._excludedPrefix = [None, None]
+
+    def _isExcluded(self, side, path, isDirectory):
+        prefix = self._excludedPrefix[side]
+        if prefix is not None and _isUnder(path, prefix):
+            return True
+        self._excludedPrefix[side] = None
+        if self._cutPath is None:
+            return False
+        if self._cutPath(os.path.join(self._basePath, *path)):
+            if isDirectory:
+                self._excludedPrefix[side] = path
+            return True
+        return False
+
+    def _account(self, side, entry):
+        path, isDirectory, size = entry
+        if not isDirectory:
+            self.totalSizes[side] += size
+            if not self._isExcluded(side, path, isDirectory):
+                self.backupSizes[side] += size
+            self._directories[-1][side + 1] += size
+        elif self._cutPath is not None:
+            self._isExcluded(side, path, isDirectory)
+
+    def _close(self, path):
+        """ Yield the changes of the subtrees not containing path
+        (everything if path is None).
+        """
+        for side, kind in enumerate((self.REMOVED, self.ADDED)):
+            only = self._only[side]
+            if only is not None and (path is None or
+                                     not _isUnder(path, only[0])):
+                self._only[side] = None
+                sizes = [0, 0]
+                sizes[side] = only[1]
+                yield (kind, "/".join(only[0]), sizes[0], sizes[1])
+        while self._directories and (
+                path is None or
+                not _isUnder(path, self._directories[-1][0])):
+            directory, oldSize, newSize = self._directories.pop()
+            if self._directories:
+                self._directories[-1][1] += oldSize
+                self._directories[-1][2] += newSize
+            if oldSize != newSize:
+                yield (self.CHANGED, "/".join(directory), oldSize, newSize)
+
+    def _addOnly(self, side, entry):
+        path, isDirectory, size = entry
+        only = self._only[side]
+        if only is not None and _isUnder(path, only[0]):
+            only[1] += size
+        else:
+            self._only[side] = [path, size]
+        self._account(side, entry)
+
+    def changes(self):
+        """ Yield the differences between the snapshots as (kind, path,
+        old size, new size) tuples, where path is relative to the root
+        and kind one of CHANGED, ADDED or REMOVED. A directory is
+        reported after its content. Sizes and backup sizes of the
+        snapshots are available once all changes have been yielded.
+        """
+        old, new = self._entries
+        oldEntry = next(old, None)
+        newEntry = next(new, None)
+        while oldEntry is not None or newEntry is not None:
+            if newEntry is None or (oldEntry is not None and
+                                    oldEntry[0] < newEntry[0]):
+                yield from self._close(oldEntry[0])
+                self._addOnly(0, oldEntry)
+                oldEntry = next(old, None)
+            elif oldEntry is None or newEntry[0] < oldEntry[0]:
+                yield from self._close(newEntry[0])
+                self._addOnly(1, newEntry)
+                newEntry = next(new, None)
+            else:
+                yield from self._close(oldEntry[0])
+                if oldEntry[1] == newEntry[1]:
+                    if oldEntry[1]:
+                        self._directories.append([oldEntry[0], 0, 0])
+                    self._account(0, oldEntry)
+                    self._account(1, newEntry)
+                else:
+                    # a file became a directory or vice versa
+                    self._addOnly(0, oldEntry)
+                    self._addOnly(1, newEntry)
+                oldEntry = next(old, None)
+                newEntry = next(new, None)
+        yield from self._close(None)